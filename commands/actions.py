@@ -119,7 +119,7 @@ def registra(bot, update):
                               " sia agli autisti sia ai passeggeri. Ogni violazione di"
                               " queste regole verrà punita con la rimozione dal"
                               " sistema.")
-        ReplyStatus.response_mode = 1
+        ReplyStatus.response_mode[update.message.chat_id] = 1
 
 
 def response_registra(bot, update):
@@ -135,7 +135,7 @@ def response_registra(bot, update):
                      text=f"Nuovo utente iscritto a sistema: {user} con"
                      f" chat_id {update.message.chat_id}")
     log.info(f"Nuovo utente iscritto: {user}")
-    ReplyStatus.response_mode = 0
+    ReplyStatus.response_mode.pop(update.message.chat_id, None)
 
 
 def ban_user(bot, update, args):
@@ -4,7 +4,7 @@ from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 
 import util.common as common
 from data.data_api import is_registered, get_trip, get_slots, get_name, is_suspended, get_time, remove_passenger, \
-    add_passenger, get_bookings
+    get_bookings, reserve_seat, suspend_booking, restore_suspended_booking
 from routing.filters import create_callback_data as ccd, separate_callback_data
 from util.keyboards import booking_keyboard, booking_menu_keyboard
 
@@ -146,7 +146,7 @@ def booking_handler(bot, update):
         ]
 
         trip = get_trip(direction, day, driver)
-        occupied_slots = len(trip["Permanent"]) + len(trip["Temporary"])
+        occupied_slots = trip.occupied_slots()
         total_slots = get_slots(driver)
 
         # Caso in cui l'autista tenta inutilmente di prenotarsi con sè stesso...
@@ -158,16 +158,16 @@ def booking_handler(bot, update):
             user_text = "Macchina piena, vai a piedi LOL. 🚶🏻‍♂️"
 
         # Caso in cui lo stolto passeggero si era già prenotato
-        elif chat_id in trip["Temporary"] or chat_id in trip["Permanent"] or chat_id in trip["SuspendedUsers"]:
+        elif chat_id in trip.temporary or chat_id in trip.permanent or chat_id in trip.suspended_users:
             user_text = "Ti sei già prenotato in questa data con questa persona!"
 
         else:
             # Si attende conferma dall'autista prima di aggiungere
-            trip_time = trip["Time"]
+            trip_time = trip.time
             slots = str(total_slots - occupied_slots - 1)
 
-            if "Location" in trip:
-                location = trip["Location"]
+            if trip.location is not None:
+                location = trip.location
                 user_keyboard.insert(0, [InlineKeyboardButton("📍 Mostra sulla mappa",
                                                               callback_data=ccd("SEND_LOCATION", location))])
             elif direction == "Salita":
@@ -335,7 +335,6 @@ def edit_booking(bot, update):
     #
     elif action == "CO_SUS_BOOK":
         direction, day, driver, mode = data[2:]
-        trip = get_trip(direction, day, driver)
 
         keyboard = [
             [InlineKeyboardButton("↩ Indietro", callback_data=ccd("EDIT_BOOK", "LIST"))],
@@ -343,8 +342,7 @@ def edit_booking(bot, update):
         ]
 
         if mode == "Permanent":
-            trip["Permanent"].remove(chat_id)
-            trip["SuspendedUsers"].append(chat_id)
+            suspend_booking(direction, day, driver, chat_id)
 
             user_message = "Prenotazione sospesa. Verrà ripristinata il prossimo viaggio."
             driver_message = f"[{get_name(chat_id)}](tg://user?id={chat_id})" \
@@ -352,10 +350,10 @@ def edit_booking(bot, update):
                 f" per {day.lower()} {common.dir_name(direction)}."
 
         elif mode == "SuspendedUsers":
-            occupied_slots = len(trip["Permanent"]) + len(trip["Temporary"])
-            total_slots = get_slots(driver)
+            # Il posto viene occupato solo se ancora libero, e solo in quel caso la prenotazione lascia i sospesi
+            slots = restore_suspended_booking(direction, day, driver, chat_id)
 
-            if occupied_slots >= total_slots:
+            if slots is None:
                 # Può capitare che mentre un passeggero ha reso la propria prenotazione sospesa,
                 # altre persone hanno preso il suo posto.
                 bot.edit_message_text(chat_id=chat_id,
@@ -368,9 +366,6 @@ def edit_booking(bot, update):
                                       parse_mode="Markdown")
                 return
 
-            trip["Permanent"].append(chat_id)
-            trip["SuspendedUsers"].remove(chat_id)
-
             user_message = "La prenotazione è di nuovo operativa."
             driver_message = f"[{get_name(chat_id)}](tg://user?id={chat_id})" \
                 f" ha reso operativa la sua prenotazione permanente" \
@@ -436,15 +431,18 @@ def alert_user(bot, update):
         direction, day, user, mode = data[2:]  # Utente della prenotazione
 
         trip = get_trip(direction, day, chat_id)
-        occupied_slots = len(trip["Permanent"]) + len(trip["Temporary"])
-        total_slots = get_slots(chat_id)
 
-        if occupied_slots < total_slots:
-            if user not in trip[mode]:
-                add_passenger(direction, day, chat_id, mode, user)
+        if user in trip.permanent or user in trip.temporary:
+            edited_text = "⚠ Attenzione, questa persona è già prenotata con te in questo viaggio."
+            booker_text = "⚠ Ti sei già prenotato in questa data con questa persona!"
+        else:
+            # Il controllo dei posti e la prenotazione avvengono in un unico passo
+            slots = reserve_seat(direction, day, chat_id, user, mode)
+
+            if slots is not None:
                 edited_text = "Hai una nuova prenotazione: " \
                     f"\n\n👤: [{get_name(user)}](tg://user?id={user}) ✔" \
-                    f"(*{total_slots - occupied_slots - 1} posti rimanenti*)" \
+                    f"(*{slots} posti rimanenti*)" \
                     f"\n🗓 {day}" \
                     f"\n🕓 {get_time(direction, day, chat_id)}" \
                     f"\n{common.dir_name(direction)}" \
@@ -453,13 +451,10 @@ def alert_user(bot, update):
                 booker_text = f"[{get_name(chat_id)}](tg://user?id={chat_id})" \
                     f" ha confermato la tua prenotazione."
             else:
-                edited_text = "⚠ Attenzione, questa persona è già prenotata con te in questo viaggio."
-                booker_text = "⚠ Ti sei già prenotato in questa data con questa persona!"
-        else:
-            edited_text = "⚠ Attenzione, hai esaurito i posti disponibili per questo viaggio. Non è" \
-                          " possibile confermarlo."
-            booker_text = f"⚠ Mi dispiace, ma qualcun'altro si è prenotato prima di te. Contatta " \
-                f"[{get_name(chat_id)}](tg://user?id={chat_id}) per disponibilità posti."
+                edited_text = "⚠ Attenzione, hai esaurito i posti disponibili per questo viaggio. Non è" \
+                              " possibile confermarlo."
+                booker_text = f"⚠ Mi dispiace, ma qualcun'altro si è prenotato prima di te. Contatta " \
+                    f"[{get_name(chat_id)}](tg://user?id={chat_id}) per disponibilità posti."
 
         bot.send_message(chat_id=user,
                          parse_mode="Markdown",
@@ -171,7 +171,7 @@ def me_handler(bot, update):
             [InlineKeyboardButton("🔚 Esci", callback_data=ccd("EXIT"))]
         ]
 
-        user_debits = get_all_debits(chat_id)
+        user_debits = dict(get_all_debits(chat_id))
         for creditor in user_debits:
             bot.send_message(chat_id=creditor,
                              text=f"ATTENZIONE! [{get_name(chat_id)}](tg://user?id={chat_id})"
@@ -1,12 +1,10 @@
 # -*- coding: utf-8 -*-
-import math
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 
-from data.data_api import (get_name, is_driver, set_single_debit, get_single_debit,
+from data.data_api import (get_name, get_names, get_mentions, is_driver, set_single_debit, get_single_debit,
                            remove_single_debit, get_debit_tuple, get_credits, get_new_debitors, quick_debit_edit)
 from routing.filters import create_callback_data as ccd, separate_callback_data
 from util import common
-from util.common import PAGE_SIZE
 
 
 def check_money(bot, update):
@@ -23,10 +21,10 @@ def check_money(bot, update):
     debit_list = get_debit_tuple(chat_id)
 
     if len(debit_list) > 0:
+        mentions = get_mentions(creditor_id for creditor_id, value in debit_list)
         people = []
-        for creditor_id, value in debit_list:
-            people.append(f"[{get_name(creditor_id)}](tg://user?id={creditor_id})"
-                          f" 🚗 {str(value)} {'viaggi' if value > 1 else 'viaggio'}\n")
+        for mention, (creditor_id, value) in zip(mentions, debit_list):
+            people.append(f"{mention} 🚗 {str(value)} {'viaggi' if value > 1 else 'viaggio'}\n")
 
         message.append(f"💸 Al momento risultano viaggi da pagare alle seguenti persone:\n{''.join(people)}"
                        f"\nContatta ciascun autista per saldare i relativi debiti.")
@@ -40,8 +38,9 @@ def check_money(bot, update):
 
         credit_list = get_credits(chat_id)
         if len(credit_list) > 0:
-            for debitor_id, value in credit_list:
-                keyboard.insert(0, [InlineKeyboardButton(f"{get_name(debitor_id)} 🚗 {str(value)} {'viaggi' if value > 1 else 'viaggio'}",
+            names = get_names(debitor_id for debitor_id, value in credit_list)
+            for name, (debitor_id, value) in zip(names, credit_list):
+                keyboard.insert(0, [InlineKeyboardButton(f"{name} 🚗 {str(value)} {'viaggi' if value > 1 else 'viaggio'}",
                                                          callback_data=ccd("EDIT_MONEY", "VIEW", debitor_id))])
 
             message.append("\n\n💰 Al momento possiedi queste persone hanno viaggi non saldati con te. "
@@ -144,18 +143,14 @@ def new_debitor(bot, update):
     page = int(separate_callback_data(update.callback_query.data)[1])
 
     keyboard = []
-    users = get_new_debitors(chat_id)
+    users, pages = get_new_debitors(chat_id, page)
 
-    for index in range(PAGE_SIZE * page, PAGE_SIZE * (page + 1), 1):
-        try:
-            name, name_chat_id = users[index]
-            keyboard.append([InlineKeyboardButton(name, callback_data=ccd("EDIT_MONEY", "NEW", name_chat_id))])
-        except IndexError:
-            break
+    for name, name_chat_id in users:
+        keyboard.append([InlineKeyboardButton(name, callback_data=ccd("EDIT_MONEY", "NEW", name_chat_id))])
 
     # Aggiungo un bottone per ogni pagina, in quanto la lista è troppo grande
     page_buttons = []
-    for index in range(0, int(math.ceil(len(users) / PAGE_SIZE)), 1):
+    for index in range(0, pages, 1):
         if index == page:
             text = "☑"
         else:
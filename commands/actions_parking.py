@@ -2,7 +2,7 @@
 
 from telegram import InlineKeyboardMarkup, InlineKeyboardButton
 
-from data.data_api import is_driver, get_trip_group, get_trip, get_name
+from data.data_api import is_driver, get_trip_group, get_trip, get_name, set_location
 from routing.filters import create_callback_data as ccd, separate_callback_data
 from util import common
 
@@ -22,12 +22,12 @@ def parcheggio(bot, update):
     day_trips = get_trip_group("Discesa", day)
 
     if common.is_weekday(day):
-        if chat_id in day_trips and not day_trips[chat_id]["Suspended"]:
+        if chat_id in day_trips and not day_trips[chat_id].suspended:
             for location in common.locations:
                 keyboard.insert(0, [InlineKeyboardButton(location, callback_data=ccd("CONFIRM_PARK", location))])
 
-            if "Location" in day_trips[chat_id]:
-                message = f"La posizione di ritrovo corrente è settata a: {day_trips[chat_id]['Location']}." \
+            if day_trips[chat_id].location is not None:
+                message = f"La posizione di ritrovo corrente è settata a: {day_trips[chat_id].location}." \
                     f"\nSeleziona un nuovo luogo di ritrovo."
             else:
                 message = "Seleziona il luogo di ritrovo per il viaggio di ritorno."
@@ -51,15 +51,15 @@ def confirm_parking(bot, update):
         [InlineKeyboardButton("🔚 Esci", callback_data=ccd("EXIT"))]
     ]
 
+    set_location("Discesa", common.today(), chat_id, location)
     day_group = get_trip("Discesa", common.today(), chat_id)
-    day_group["Location"] = location
 
     bot.edit_message_text(chat_id=chat_id,
                           message_id=update.callback_query.message.message_id,
                           text=f"Posizione impostata con successo: {location}",
                           reply_markup=InlineKeyboardMarkup(keyboard))
 
-    for passenger_group in day_group["Temporary"], day_group["Permanent"]:
+    for passenger_group in list(day_group.temporary), list(day_group.permanent):
         for passenger in passenger_group:
             bot.send_message(chat_id=passenger,
                              text=f"Per il viaggio di ritorno,"
@@ -2,7 +2,7 @@ import datetime
 
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 
-from data.data_api import get_trip, get_name, is_registered, get_all_trips_fixed_direction
+from data.data_api import get_trip, get_mention, get_mentions, is_registered, get_all_trips_fixed_direction
 from routing.filters import separate_callback_data, create_callback_data as ccd
 from util import common
 
@@ -46,10 +46,10 @@ def fetch_sessione():
                 for time, driver in bookings:
                     trip = get_trip(direction, day, driver)
                     # Raccolgo in una list comprehension le persone che partecipano al viaggio
-                    people = [f"[{get_name(user)}](tg://user?id={user})" for user in trip["Temporary"]]
+                    people = get_mentions(trip.temporary)
 
                     # Aggiungo ogni viaggio trovato alla lista
-                    text.append(f"\n🚗 [{get_name(driver)}](tg://user?id={driver}) "
+                    text.append(f"\n🚗 {get_mention(driver)} "
                                 f"(*{time}*, {common.dir_name(direction)}): {', '.join(people)}\n")
 
         if empty_day:
@@ -77,13 +77,11 @@ def fetch_bookings(chat_id, day):
                 for time, driver in bookings:
                     trip = get_trip(direction, day, driver)
                     # Raccolgo in una list comprehension le persone che partecipano al viaggio
-                    people = [f"[{get_name(user)}](tg://user?id={user})"
-                              for mode in trip
-                              if mode == "Temporary" or mode == "Permanent"
-                              for user in trip[mode]]
+                    people = get_mentions(user for user_group in (trip.permanent, trip.temporary)
+                                          for user in user_group)
 
                     # Aggiungo ogni viaggio trovato alla lista
-                    text.append(f"\n🚗 [{get_name(driver)}](tg://user?id={driver})"
+                    text.append(f"\n🚗 {get_mention(driver)}"
                                 f" - 🕓 *{time}*:"
                                 f"\n👥 {', '.join(people)}\n")
             else:
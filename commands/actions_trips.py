@@ -1,11 +1,10 @@
 # -*- coding: utf-8 -*-
 import datetime
 
-import math
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 
 from data.data_api import get_trip, get_name, is_suspended, unsuspend_trip, suspend_trip, remove_passenger, get_time, \
-    remove_trip, get_slots, new_trip, get_new_passengers
+    remove_trip, new_trip, get_new_passengers, set_time, reserve_seat, get_mentions
 from routing.filters import separate_callback_data, create_callback_data as ccd
 from util import common
 from util.common import dir_name
@@ -45,7 +44,7 @@ def trips_handler(bot, update):
         direction, day = data[2:4]
         trip = get_trip(direction, day, chat_id)
 
-        if trip["Suspended"]:
+        if trip.suspended:
             text_string = " - 🚫 Sospeso"
             keyboard = [[InlineKeyboardButton("✔ Annullare la sospensione",
                                               callback_data=ccd("TRIPS", "SUS_TRIP", direction, day))]]
@@ -75,12 +74,9 @@ def trips_handler(bot, update):
             [InlineKeyboardButton("🔚 Uscire", callback_data=ccd("EXIT"))]
         ]
 
-        temporary_passengers = ", ".join(f"[{get_name(user)}](tg://user?id={user})"
-                                         for user in trip['Temporary'])
-        permanent_passengers = ", ".join(f"[{get_name(user)}](tg://user?id={user})"
-                                         for user in trip['Permanent'])
-        suspended_passengers = ", ".join(f"[{get_name(user)}](tg://user?id={user})"
-                                         for user in trip['SuspendedUsers'])
+        temporary_passengers = ", ".join(get_mentions(trip.temporary))
+        permanent_passengers = ", ".join(get_mentions(trip.permanent))
+        suspended_passengers = ", ".join(get_mentions(trip.suspended_users))
 
         if common.is_sessione():
             # Numero di giorni da sommare al giorno corrente
@@ -94,7 +90,7 @@ def trips_handler(bot, update):
                               text=f"Viaggio selezionato: {text_string}"
                               f"\n\n🗓 {shown_day}"
                               f"\n{common.dir_name(direction)}"
-                              f"\n🕓 {trip['Time']}"
+                              f"\n🕓 {trip.time}"
                               f"\n👥 (_temporanei_) {temporary_passengers}"
                               f"\n👥 (_permanenti_) {permanent_passengers}"
                               f"\n👥 (_sospesi_) {suspended_passengers}"
@@ -194,16 +190,16 @@ def trips_handler(bot, update):
     # Metodo chiamato per la conferma dell'orario appena modificato.
     elif action == "CO_EDIT_TRIP":
         direction, day, hour, minute = data[2:6]
-        trip = get_trip(direction, str(day), chat_id)
-
-        time = trip["Time"] = f"{hour.zfill(2)}:{minute.zfill(2)}"
+        time = f"{hour.zfill(2)}:{minute.zfill(2)}"
+        set_time(direction, day, chat_id, time)
+        trip = get_trip(direction, day, chat_id)
 
         keyboard = [
             [InlineKeyboardButton("↩ Indietro", callback_data=ccd("ME", "TRIPS"))],
             [InlineKeyboardButton("🔚 Esci", callback_data=ccd("EXIT"))]
         ]
 
-        for user_group in trip["Permanent"], trip["Temporary"]:
+        for user_group in list(trip.permanent), list(trip.temporary):
             for user in user_group:
                 bot.send_message(chat_id=user,
                                  text=f"[{get_name(chat_id)}](tg://user?id={chat_id})"
@@ -227,9 +223,9 @@ def trips_handler(bot, update):
 
         trip = get_trip(direction, day, chat_id)
 
-        permanent_users = trip["Permanent"]
-        temporary_users = trip["Temporary"]
-        suspended_users = trip["SuspendedUsers"]
+        permanent_users = trip.permanent
+        temporary_users = trip.temporary
+        suspended_users = trip.suspended_users
 
         # Lista delle persone prenotate divise per Permanente e Temporanea
 
@@ -342,19 +338,15 @@ def add_passenger(bot, update):
 
         keyboard = []
         page = int(page)
-        users = get_new_passengers(chat_id)
+        users, pages = get_new_passengers(chat_id, page)
 
-        for index in range(common.PAGE_SIZE * page, common.PAGE_SIZE * (page + 1), 1):
-            try:
-                name, id = users[index]
-                keyboard.append([InlineKeyboardButton(
-                    name, callback_data=ccd("ADD_PASS", "MODE", direction, day, id))])
-            except IndexError:
-                break
+        for name, id in users:
+            keyboard.append([InlineKeyboardButton(
+                name, callback_data=ccd("ADD_PASS", "MODE", direction, day, id))])
 
         # Aggiungo un bottone per ogni pagina, in quanto la lista è troppo grande
         page_buttons = []
-        for index in range(0, int(math.ceil(len(users) / common.PAGE_SIZE)), 1):
+        for index in range(0, pages, 1):
             if index == page:
                 text = "☑"
             else:
@@ -407,29 +399,26 @@ def add_passenger(bot, update):
         ]
 
         trip = get_trip(direction, day, chat_id)
-        occupied_slots = len(trip["Permanent"]) + len(trip["Temporary"])
-        total_slots = get_slots(chat_id)
 
-        if user in trip["Temporary"] or user in trip["Permanent"]:
+        if user in trip.temporary or user in trip.permanent:
             bot.edit_message_text(chat_id=chat_id,
                                   message_id=update.callback_query.message.message_id,
                                   text="Questa persona si è già prenotata in questo viaggio!",
                                   reply_markup=InlineKeyboardMarkup(keyboard))
 
-        elif occupied_slots >= total_slots:
+        # Il controllo dei posti e la prenotazione avvengono in un unico passo
+        elif reserve_seat(direction, day, chat_id, str(user), mode) is None:
             bot.edit_message_text(chat_id=chat_id,
                                   message_id=update.callback_query.message.message_id,
                                   text="Temo che il tuo amico dovrà andare a piedi, i posti sono finiti.",
                                   reply_markup=InlineKeyboardMarkup(keyboard))
 
         else:
-            trip[mode].append(str(user))
-
             bot.send_message(chat_id=user,
                              text=f"[{get_name(chat_id)}](tg://user?id={chat_id})"
                              f" ha effettuato una nuova prenotazione a tuo nome nel suo viaggio: "
                              f"\n\n🗓 {day}"
-                             f"\n🕓 {trip['Time']}"
+                             f"\n🕓 {trip.time}"
                              f"\n{common.dir_name(direction)}"
                              f"{common.mode_name(mode)}",
                              parse_mode="Markdown")
@@ -440,7 +429,7 @@ def add_passenger(bot, update):
                                   text="Prenotazione completata. Dati del viaggio:"
                                   f"\n\n👤 {str(get_name(user))}"
                                   f"\n🗓 {day}"
-                                  f"\n🕓 {trip['Time']}"
+                                  f"\n🕓 {trip.time}"
                                   f"\n{common.dir_name(direction)}"
                                   f"\n{common.mode_name(mode)}")
 
@@ -550,10 +539,10 @@ def alert_suspension(bot, direction, day, driver):
     trip = get_trip(direction, day, driver)
     driver_name = f"[{get_name(driver)}](tg://user?id={driver})"
 
-    permanent_users = trip["Permanent"]
-    temporary_users = trip["Temporary"]
+    permanent_users = list(trip.permanent)
+    temporary_users = list(trip.temporary)
 
-    if trip["Suspended"]:
+    if trip.suspended:
         for user in permanent_users:
             bot.send_message(chat_id=user,
                              text=f"Attenzione! {driver_name} ha sospeso il viaggio di {day}"
@@ -566,8 +555,9 @@ def alert_suspension(bot, direction, day, driver):
                              f" La tua prenotazione scalerà alla settimana successiva.",
                              parse_mode="Markdown")
     else:
-        for user in (permanent_users + temporary_users):
-            bot.send_message(chat_id=user,
-                             text=f"Attenzione! {driver_name} ha annullato la sospensione del viaggio di {day}"
-                             f" {dir_name(direction)}.",
-                             parse_mode="Markdown")
+        for user_group in permanent_users, temporary_users:
+            for user in user_group:
+                bot.send_message(chat_id=user,
+                                 text=f"Attenzione! {driver_name} ha annullato la sospensione del viaggio di {day}"
+                                 f" {dir_name(direction)}.",
+                                 parse_mode="Markdown")
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+
+import json
+import struct
+import zlib
+
+#
+# Formato binario compatto usato per salvare utenti, autisti e viaggi. Ogni blocco inizia con due byte,
+# la versione del formato e i flag, seguiti dalla tabella delle stringhe e dal valore vero e proprio.
+# Ogni stringa (chat_id compresi) viene salvata una sola volta nella tabella e poi richiamata con il suo
+# indice; i chat_id vengono salvati come numeri invece che come stringhe decimali.
+# I blocchi salvati in JSON dalle versioni precedenti vengono letti in modo trasparente.
+#
+
+VERSION = 1
+COMPRESSED = 0x01  # Flag: il contenuto è compresso con zlib
+
+# Tipi dei valori
+NONE, FALSE, TRUE, INT, FLOAT, STRING, LIST, DICT = range(8)
+
+# Tipi delle voci nella tabella delle stringhe
+TEXT, NUMBER = range(2)
+
+# Stringhe sempre presenti, che non vengono salvate nella tabella. ATTENZIONE: la lista può solo
+# essere estesa in coda, altrimenti i dati già salvati non saranno più leggibili.
+KNOWN_STRINGS = ["Name", "Debit", "Slots", "Time", "Permanent", "Temporary", "SuspendedUsers", "Suspended",
+                 "Location", "Salita", "Discesa", "Lunedì", "Martedì", "Mercoledì", "Giovedì", "Venerdì",
+                 "Sabato", "Domenica", "Ops", "Changes"]
+KNOWN_INDEXES = {string: index for index, string in enumerate(KNOWN_STRINGS)}
+
+
+def encode(value):
+    """
+    Encodes a JSON-like value (dicts, lists, strings, numbers, booleans and None) in the compact format.
+    :param value: The value to encode.
+    :return: A bytes object.
+    """
+    table = dict(KNOWN_INDEXES)
+    strings = []
+    body = bytearray()
+
+    def write_varint(number, out):
+        while number > 0x7f:
+            out.append((number & 0x7f) | 0x80)
+            number >>= 7
+        out.append(number)
+
+    def write_value(item):
+        if item is None:
+            body.append(NONE)
+        elif item is True:
+            body.append(TRUE)
+        elif item is False:
+            body.append(FALSE)
+        elif isinstance(item, int):
+            body.append(INT)
+            write_varint(zigzag(item), body)
+        elif isinstance(item, float):
+            body.append(FLOAT)
+            body.extend(struct.pack("<d", item))
+        elif isinstance(item, str):
+            index = table.get(item)
+            if index is None:
+                index = table[item] = len(table)
+                strings.append(item)
+            body.append(STRING)
+            write_varint(index, body)
+        elif isinstance(item, (list, tuple)):
+            body.append(LIST)
+            write_varint(len(item), body)
+            for element in item:
+                write_value(element)
+        elif isinstance(item, dict):
+            body.append(DICT)
+            write_varint(len(item), body)
+            for key, element in item.items():
+                write_value(key)
+                write_value(element)
+        else:
+            raise TypeError(f"Cannot encode {type(item).__name__}")
+
+    write_value(value)
+
+    payload = bytearray()
+    write_varint(len(strings), payload)
+    for string in strings:
+        if is_number(string):
+            payload.append(NUMBER)
+            write_varint(zigzag(int(string)), payload)
+        else:
+            data = string.encode("utf-8")
+            payload.append(TEXT)
+            write_varint(len(data), payload)
+            payload.extend(data)
+    payload.extend(body)
+
+    flags = 0
+    compressed = zlib.compress(payload)
+    if len(compressed) < len(payload):
+        payload, flags = compressed, COMPRESSED
+
+    return bytes((VERSION, flags)) + bytes(payload)
+
+
+def decode(data):
+    """
+    Decodes a value saved with encode, or with json.dumps by the previous versions of the bot.
+    :param data: A bytes object or a string.
+    :return: The decoded value.
+    """
+    if is_legacy(data):
+        return json.loads(data)
+
+    version, flags = data[0], data[1]
+    if version != VERSION:
+        raise ValueError(f"Unknown data format version: {version}")
+
+    payload = zlib.decompress(data[2:]) if flags & COMPRESSED else bytes(data[2:])
+    position = 0
+
+    def read_varint():
+        nonlocal position
+        number = shift = 0
+        while True:
+            byte = payload[position]
+            position += 1
+            number |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                return number
+            shift += 7
+
+    strings = list(KNOWN_STRINGS)
+    for _ in range(read_varint()):
+        kind = payload[position]
+        position += 1
+        if kind == NUMBER:
+            strings.append(str(unzigzag(read_varint())))
+        else:
+            length = read_varint()
+            strings.append(payload[position:position + length].decode("utf-8"))
+            position += length
+
+    def read_value():
+        nonlocal position
+        tag = payload[position]
+        position += 1
+
+        if tag == STRING:
+            return strings[read_varint()]
+        elif tag == DICT:
+            result = {}
+            for _ in range(read_varint()):
+                key = read_value()
+                result[key] = read_value()
+            return result
+        elif tag == LIST:
+            return [read_value() for _ in range(read_varint())]
+        elif tag == INT:
+            return unzigzag(read_varint())
+        elif tag == TRUE:
+            return True
+        elif tag == FALSE:
+            return False
+        elif tag == NONE:
+            return None
+        elif tag == FLOAT:
+            position += 8
+            return struct.unpack_from("<d", payload, position - 8)[0]
+        else:
+            raise ValueError(f"Unknown value type: {tag}")
+
+    return read_value()
+
+
+def is_legacy(data):
+    """Checks whether the data was saved as JSON by a previous version of the bot"""
+    return isinstance(data, str) or data[:1] in (b"{", b"[")
+
+
+def is_number(string):
+    """Checks whether a string is a decimal integer that can be rebuilt exactly from its value (es. a chat_id)"""
+    digits = string[1:] if string.startswith("-") else string
+    return digits.isascii() and digits.isdigit() and (digits == "0" or digits[0] != "0") and string != "-0"
+
+
+def zigzag(number):
+    return number * 2 if number >= 0 else -number * 2 - 1
+
+
+def unzigzag(number):
+    return number // 2 if not number & 1 else -(number + 1) // 2
@@ -1,12 +1,409 @@
 # -*- coding: utf-8 -*-
 
+import bisect
+import heapq
+import logging as log
+import math
+import threading
+from contextlib import contextmanager
+from functools import wraps
+
 import data.dataset as dt
-from util.common import work_days
+from data.dumpable import mark_dirty, lock, record_mutation, pending, dirty, set_item, Sync, Undo
+from data.model import User, Driver, Trip, intern
+from util.common import work_days, PAGE_SIZE, time_to_minutes
+
+
+# Lock che protegge la costruzione degli indici, che può avvenire in parallelo da più handler in lettura
+index_lock = threading.RLock()
+
+
+class Mutations:
+    depth = 0  # Numero di mutator annidati in esecuzione (protetto dal lock)
+    count = 0  # Numero di mutator eseguiti, usato per riconoscere i dati modificati
+
+
+# Mutazioni che occupano un posto solo se ancora libero, ritornando None altrimenti. Il passeggero viene avvisato
+# in base al risultato, quindi se la mutazione viene rifiutata quando è riapplicata dopo un conflitto con un'altra
+# istanza l'avviso non è più valido (vedi dumpable.replay_on_fresh_data)
+SEAT_MUTATIONS = {"reserve_seat", "restore_suspended_booking"}
+
+
+class LazyIndex:
+    """
+    Index derived from the dataset, built by its build function the first time it is used. Every index is built
+    again whenever Sync.generation changes (loads, log records of other instances, rolled back transactions),
+    while in between the mutators keep it up to date through current. Calling it returns the index.
+    """
+
+    def __init__(self, build):
+        self.build = build
+        self.value = None
+        self.generation = None  # Valore di Sync.generation per cui l'indice è stato costruito
+
+    def __call__(self):
+        with lock.reading(), index_lock:
+            if self.generation != Sync.generation:
+                self.value, self.generation = self.build(), Sync.generation
+
+            return self.value
+
+    def current(self):
+        """Returns the index if it is up to date, or None if it is outdated and is going to be rebuilt anyway"""
+        return self.value if self.generation == Sync.generation else None
+
+
+def mutator(func):
+    """
+    Decorator for every function that modifies the dataset. The modification is performed while holding
+    the dataset lock, so that the flusher never serializes a half-updated entity, and inside a transaction,
+    so that it is undone if it fails halfway. Once completed, the outermost call is recorded, so that it can
+    be replayed if the save conflicts with another instance. Only the calls are replayed, not the code around
+    them: when further modifications depend on the result of a mutator, the whole flow must be a mutator
+    itself (see charge_trip), so that the decision is taken again on the saved values.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with lock:
+            Mutations.depth += 1
+            Mutations.count += 1
+            try:
+                with transaction():
+                    result = func(*args, **kwargs)
+            finally:
+                Mutations.depth -= 1
+
+            if Mutations.depth == 0:
+                record_mutation(func.__name__, args, kwargs)
+
+            return result
+
+    return wrapper
+
+
+@contextmanager
+def transaction():
+    """
+    Groups several modifications into a single unit: if the block raises an exception, every user, driver
+    and trip it changed is restored, and its mutations are not saved. The lock is held for the whole block,
+    so the flusher saves either all of its changes or none of them. Nested transactions are part of the
+    outermost one. Sending messages inside a transaction should be avoided, since it keeps the lock held.
+    If the save conflicts with another instance, the mutations of the block are replayed one by one: modifications
+    that must stay together also across instances belong in a single mutator (see suspend_booking).
+    """
+    with lock:
+        if Undo.entries is not None:
+            yield
+            return
+
+        Undo.entries = {}
+        mutations = len(pending)
+        changed = set(dirty)
+        try:
+            yield
+        except BaseException:
+            rollback(Undo.entries, mutations, changed)
+            raise
+        finally:
+            Undo.entries = None
+
+
+def rollback(entries, mutations, changed):
+    """
+    Restores the items changed by a failed transaction. MUST BE called while holding the lock.
+    :param entries: The values of the items before the transaction, as collected by mark_dirty.
+    :param mutations: The number of pending mutations when the transaction started.
+    :param changed: The items that were already waiting to be saved when the transaction started.
+    """
+    del pending[mutations:]
+    # Le entità ripristinate non vanno salvate, a meno che non fossero già state modificate prima
+    dirty.intersection_update(changed)
+    if not entries:
+        return
+
+    for item, value in entries.items():
+        set_item(item, value, dt.groups, dt.users, dt.drivers)
+
+    # Gli indici potrebbero essere stati aggiornati a metà, quindi vanno ricostruiti
+    Sync.generation += 1
+
+
+def data_version():
+    """
+    Returns a value that changes whenever the dataset is modified or reloaded, to validate cached results.
+    :return: A tuple that can be compared with the ones returned before.
+    """
+    return Sync.generation, Mutations.count
+
+
+def build_bookings():
+    """
+    Builds the reverse index from each passenger to its bookings, kept as dicts with (direction, day, driver, mode)
+    keys and None values, so that they behave as sets while preserving the booking order.
+    """
+    index = {}
+    for direction in dt.groups:
+        for day in dt.groups[direction]:
+            for driver, trip in dt.groups[direction][day].items():
+                for mode in Trip.MODES:
+                    for person in trip.passengers(mode):
+                        index.setdefault(person, {})[(direction, day, driver, mode)] = None
+
+    return index
+
+
+bookings_index = LazyIndex(build_bookings)
+
+
+def index_booking(person, booking):
+    """Adds a booking to the index"""
+    index = bookings_index.current()
+    if index is not None:
+        index.setdefault(person, {})[booking] = None
+
+
+def unindex_booking(person, booking):
+    """Removes a booking from the index"""
+    index = bookings_index.current()
+    if index is not None:
+        bookings = index.get(person, {})
+        bookings.pop(booking, None)
+        if not bookings:
+            index.pop(person, None)
+
+
+def unindex_trip(direction, day, driver):
+    """Removes every booking of a trip from the index. MUST BE called before deleting or replacing the trip"""
+    trip = dt.groups[direction][day].get(driver)
+    if trip is not None:
+        for mode in Trip.MODES:
+            for person in trip.passengers(mode):
+                unindex_booking(person, (direction, day, driver, mode))
+
+
+def departure_minutes(direction, day, driver):
+    """
+    Returns the departure time of a trip in minutes since midnight, or None if the saved time is malformed.
+    Such trips are left out of the departures, so that they do not break the listings of their day.
+    """
+    time = dt.groups[direction][day][driver].time
+    try:
+        return time_to_minutes(time)
+    except (ValueError, AttributeError):
+        log.warning(f"Malformed time {time!r} of trip {direction}/{day}/{driver}")
+        return None
+
+
+def build_departures():
+    """
+    Builds the trips of each (direction, day) tuple, as lists of (minutes, driver) tuples sorted by departure time.
+    Suspended trips are included, so that suspending a trip does not move it.
+    """
+    index = {}
+    for direction in dt.groups:
+        for day in dt.groups[direction]:
+            entries = index[(direction, day)] = []
+            for driver in dt.groups[direction][day]:
+                minutes = departure_minutes(direction, day, driver)
+                if minutes is not None:
+                    entries.append((minutes, driver))
+            entries.sort()
+
+    return index
+
+
+departures_index = LazyIndex(build_departures)
+
+
+def index_departure(direction, day, driver):
+    """Adds a trip to the departures"""
+    index = departures_index.current()
+    if index is not None:
+        minutes = departure_minutes(direction, day, driver)
+        if minutes is not None:
+            bisect.insort(index.setdefault((direction, day), []), (minutes, driver))
+
+
+def unindex_departure(direction, day, driver):
+    """Removes a trip from the departures. MUST BE called before deleting the trip or changing its time"""
+    index = departures_index.current()
+    if index is not None and driver in dt.groups[direction][day]:
+        minutes = departure_minutes(direction, day, driver)
+        if minutes is None:
+            return
+
+        entries = index.get((direction, day), [])
+        entry = (minutes, driver)
+        position = bisect.bisect_left(entries, entry)
+        if position < len(entries) and entries[position] == entry:
+            del entries[position]
+
+
+def search_prefixes(day, driver):
+    """Returns the prefixes under which a trip is indexed for the inline queries"""
+    words = day.lower().split()
+    if driver in dt.users:
+        words += dt.users[driver].name.lower().split()
+
+    return {word[:length] for word in words for length in range(1, len(word) + 1)}
+
+
+def build_search():
+    """
+    Builds the index for the inline queries, from every prefix of the lowercase words of day names and driver
+    names to the matching trips, kept as dicts with (direction, day, driver) keys and None values.
+    """
+    index = {}
+    for direction in dt.groups:
+        for day in dt.groups[direction]:
+            for driver in dt.groups[direction][day]:
+                for prefix in search_prefixes(day, driver):
+                    index.setdefault(prefix, {})[(direction, day, driver)] = None
+
+    return index
+
+
+search_index = LazyIndex(build_search)
+
+
+def index_search(direction, day, driver):
+    """Adds a trip to the search index"""
+    index = search_index.current()
+    if index is not None:
+        for prefix in search_prefixes(day, driver):
+            index.setdefault(prefix, {})[(direction, day, driver)] = None
+
+
+def unindex_search(direction, day, driver):
+    """Removes a trip from the search index. MUST BE called before deleting the trip or renaming its driver"""
+    index = search_index.current()
+    if index is not None:
+        for prefix in search_prefixes(day, driver):
+            trips = index.get(prefix)
+            if trips is not None:
+                trips.pop((direction, day, driver), None)
+                if not trips:
+                    del index[prefix]
+
+
+def build_credits():
+    """
+    Builds the reverse index from each creditor to its debitors, kept as dicts with debitor keys and None values.
+    The debits themselves stay in the Debit dict of each debitor.
+    """
+    index = {}
+    for user in dt.users:
+        for creditor in dt.users[user].debit:
+            index.setdefault(creditor, {})[user] = None
+
+    return index
+
+
+credits_index = LazyIndex(build_credits)
+
+
+def index_debit(chat_id, creditor):
+    """Adds a debit to the index"""
+    index = credits_index.current()
+    if index is not None:
+        index.setdefault(creditor, {})[chat_id] = None
+
+
+def unindex_debit(chat_id, creditor):
+    """Removes a debit from the index"""
+    index = credits_index.current()
+    if index is not None:
+        debitors = index.get(creditor, {})
+        debitors.pop(chat_id, None)
+        if not debitors:
+            index.pop(creditor, None)
+
+
+def unindex_debits(chat_id):
+    """Removes every debit of a user from the index. MUST BE called before deleting or replacing the user"""
+    if chat_id in dt.users:
+        for creditor in dt.users[chat_id].debit:
+            unindex_debit(chat_id, creditor)
+
+
+def build_names():
+    """Builds the list of (name, chat_id) tuples of every user, kept sorted for the paginated user pickers"""
+    return sorted((dt.users[user].name, user) for user in dt.users)
+
+
+names_index = LazyIndex(build_names)
+
+
+def index_name(chat_id):
+    """Adds a user to the sorted names"""
+    entries = names_index.current()
+    if entries is not None:
+        bisect.insort(entries, (dt.users[chat_id].name, chat_id))
+
+
+def unindex_name(chat_id):
+    """Removes a user from the sorted names. MUST BE called before deleting or replacing the user"""
+    entries = names_index.current()
+    if entries is not None and chat_id in dt.users:
+        entry = (dt.users[chat_id].name, chat_id)
+        position = bisect.bisect_left(entries, entry)
+        if position < len(entries) and entries[position] == entry:
+            del entries[position]
+
+
+# Menzioni Markdown degli utenti, come stringhe [nome](tg://user?id=chat_id) formattate una volta sola e riusate
+mentions_cache = LazyIndex(dict)
+
+
+def unindex_mention(chat_id):
+    """Removes the cached mention of a user. MUST BE called when the user is replaced or deleted"""
+    cache = mentions_cache.current()
+    if cache is not None:
+        cache.pop(chat_id, None)
+
+
+def get_users_page(page, excluded):
+    """
+    Returns a page of the users sorted by name, skipping some of them, without going through the whole list.
+    :param page: The number of the page, starting from 0.
+    :param excluded: The chat_ids of the users to skip.
+    :return: A tuple containing the list of (name, chat_id) tuples of the page and the total number of pages.
+    """
+    entries = names_index()
+
+    # Posizioni degli utenti esclusi nella lista ordinata
+    skipped = []
+    for chat_id in set(excluded):
+        if chat_id in dt.users:
+            entry = (dt.users[chat_id].name, chat_id)
+            index = bisect.bisect_left(entries, entry)
+            if index < len(entries) and entries[index] == entry:
+                skipped.append(index)
+    skipped.sort()
+
+    # Posizione del primo utente della pagina, contando anche gli esclusi che lo precedono
+    start = page * PAGE_SIZE
+    for index in skipped:
+        if index <= start:
+            start += 1
+        else:
+            break
+
+    skipped = set(skipped)
+    result = []
+    index = start
+    while len(result) < PAGE_SIZE and index < len(entries):
+        if index not in skipped:
+            result.append(entries[index])
+        index += 1
+
+    return result, int(math.ceil((len(entries) - len(skipped)) / PAGE_SIZE))
 
 
 # Utenti
 
 
+@mutator
 def add_user(chat_id, user):
     """
     This function adds a user to a dataset, given its chat id.
@@ -14,7 +411,19 @@ def add_user(chat_id, user):
     :param user: The username.
     :return:
     """
-    dt.users[str(chat_id)] = {"Name": str(user), "Debit": {}}
+    chat_id = intern(chat_id)
+    trips = [(direction, day) for direction in dt.groups for day in dt.groups[direction]
+             if chat_id in dt.groups[direction][day]]
+    unindex_debits(chat_id)
+    unindex_name(chat_id)
+    unindex_mention(chat_id)
+    for direction, day in trips:
+        unindex_search(direction, day, chat_id)
+    mark_dirty("User", chat_id)
+    dt.users[chat_id] = User(str(user))
+    index_name(chat_id)
+    for direction, day in trips:
+        index_search(direction, day, chat_id)
 
 
 def is_registered(chat_id):
@@ -32,7 +441,44 @@ def get_name(chat_id):
     :param chat_id: The chat_id to check.
     :return: A string representing the relative username
     """
-    return dt.users[chat_id]["Name"]
+    return dt.users[chat_id].name
+
+
+def get_names(chat_ids):
+    """
+    Returns the usernames of several chat_ids at once.
+    :param chat_ids: An iterable of chat_ids.
+    :return: A list with the username of each chat_id, in the same order.
+    """
+    users = dt.users
+    return [users[chat_id].name for chat_id in chat_ids]
+
+
+def get_mention(chat_id):
+    """
+    Returns the Markdown mention of a chat_id, formatting it only the first time.
+    :param chat_id: The chat_id to mention.
+    :return: A string in the [name](tg://user?id=chat_id) format.
+    """
+    return get_mentions((chat_id,))[0]
+
+
+def get_mentions(chat_ids):
+    """
+    Returns the Markdown mentions of several chat_ids at once, formatting only the ones not cached yet.
+    :param chat_ids: An iterable of chat_ids.
+    :return: A list with the [name](tg://user?id=chat_id) mention of each chat_id, in the same order.
+    """
+    with lock.reading(), index_lock:
+        cache = mentions_cache()
+        result = []
+        for chat_id in chat_ids:
+            mention = cache.get(chat_id)
+            if mention is None:
+                mention = cache[chat_id] = f"[{dt.users[chat_id].name}](tg://user?id={chat_id})"
+            result.append(mention)
+
+        return result
 
 
 def all_users():
@@ -42,16 +488,26 @@ def all_users():
     return dt.users.keys()
 
 
+@mutator
 def delete_user(chat_id):
     """
-    Wipes a user from the system, including driver data if present
+    Wipes a user from the system, including its bookings and driver data if present
     :param chat_id: The chat_id to delete.
     :return:
     """
-    del dt.users[chat_id]
+    for direction, day, driver, mode in list(bookings_index().get(chat_id, ())):
+        remove_passenger(direction, day, driver, mode, chat_id)
+
+    # I viaggi vanno rimossi prima dell'utente, dato che l'indice di ricerca usa il nome dell'autista
     if is_driver(chat_id):
         delete_driver(chat_id)
 
+    unindex_debits(chat_id)
+    unindex_name(chat_id)
+    unindex_mention(chat_id)
+    mark_dirty("User", chat_id)
+    del dt.users[chat_id]
+
 
 # Debiti
 
@@ -64,11 +520,12 @@ def get_single_debit(chat_id, creditor):
     :return: The value owed
     """
     try:
-        return dt.users[chat_id]["Debit"][creditor]
+        return dt.users[chat_id].debit[creditor]
     except KeyError:
         return None
 
 
+@mutator
 def set_single_debit(chat_id, creditor, value):
     """
     Sets a debit to an arbitrary velue
@@ -77,9 +534,13 @@ def set_single_debit(chat_id, creditor, value):
     :param value: The value to be placed
     :return:
     """
-    dt.users[chat_id]["Debit"][creditor] = value
+    creditor = intern(creditor)
+    mark_dirty("User", chat_id)
+    dt.users[chat_id].debit[creditor] = value
+    index_debit(chat_id, creditor)
 
 
+@mutator
 def quick_debit_edit(chat_id, creditor, mode):
     """
     Quick edit mode for any debit. Gets the added/subtracted value from common.py. Available options:
@@ -91,26 +552,45 @@ def quick_debit_edit(chat_id, creditor, mode):
     :param mode: The mode to operate with
     :return:
     """
+    creditor = intern(creditor)
+    mark_dirty("User", chat_id)
 
     if mode == "+":
         try:
-            dt.users[chat_id]["Debit"][creditor] += 1
+            dt.users[chat_id].debit[creditor] += 1
         except KeyError:
-            dt.users[chat_id]["Debit"][creditor] = 1
+            dt.users[chat_id].debit[creditor] = 1
 
     elif mode == "-":
         try:
-            dt.users[chat_id]["Debit"][creditor] -= 1
+            dt.users[chat_id].debit[creditor] -= 1
         except KeyError:
-            dt.users[chat_id]["Debit"][creditor] = -1
+            dt.users[chat_id].debit[creditor] = -1
 
     elif mode == "0":
-        dt.users[chat_id]["Debit"][creditor] = 0
+        dt.users[chat_id].debit[creditor] = 0
 
     else:
         raise ValueError
 
-    return dt.users[chat_id]["Debit"][creditor]
+    index_debit(chat_id, creditor)
+    return dt.users[chat_id].debit[creditor]
+
+
+@mutator
+def charge_trip(chat_id, creditor):
+    """
+    Adds a trip to pay to a debit, removing the debit if it goes back to zero.
+    :param chat_id: The debitor
+    :param creditor: The creditor
+    :return: The new value of the debit
+    """
+    debit = quick_debit_edit(chat_id, creditor, "+")
+
+    if debit == 0:
+        remove_single_debit(chat_id, intern(creditor))
+
+    return debit
 
 
 def get_all_debits(chat_id):
@@ -119,9 +599,10 @@ def get_all_debits(chat_id):
     :param chat_id: The chat_id to get the debits from.
     :return: A dictionary with keys containing chat_ids and values containing debits
     """
-    return dt.users[chat_id]["Debit"]
+    return dt.users[chat_id].debit
 
 
+@mutator
 def remove_single_debit(chat_id, creditor):
     """
     Wipes a debit from a user's debit list.
@@ -129,12 +610,15 @@ def remove_single_debit(chat_id, creditor):
     :param creditor: The creditor to delete from the list.
     :return:
     """
-    del dt.users[chat_id]["Debit"][creditor]
+    mark_dirty("User", chat_id)
+    del dt.users[chat_id].debit[creditor]
+    unindex_debit(chat_id, creditor)
 
 
 # Autisti
 
 
+@mutator
 def add_driver(chat_id, slots):
     """
     Adds a currently registered user to the driver list.
@@ -142,7 +626,8 @@ def add_driver(chat_id, slots):
     :param slots:T The amount of seats, driver excluded
     :return:
     """
-    dt.drivers[chat_id] = {"Slots": slots}
+    mark_dirty("Driver", chat_id)
+    dt.drivers[intern(chat_id)] = Driver(slots)
 
 
 def is_driver(chat_id):
@@ -154,22 +639,29 @@ def is_driver(chat_id):
     return chat_id in dt.drivers
 
 
+@mutator
 def delete_driver(chat_id):
     """
     Wipes a driver from the driver list.
     :param chat_id: The chat_id to remove.
     :return:
     """
+    mark_dirty("Driver", chat_id)
     del dt.drivers[chat_id]
 
     for direction in dt.groups:
         for day in dt.groups[direction]:
             if chat_id in dt.groups[direction][day]:
+                unindex_trip(direction, day, chat_id)
+                unindex_departure(direction, day, chat_id)
+                unindex_search(direction, day, chat_id)
+                mark_dirty("Trip", direction, day, chat_id)
                 del dt.groups[direction][day][chat_id]
 
-    for user in dt.users:
-        if chat_id in dt.users[user]["Debit"]:
-            del dt.users[user]["Debit"][chat_id]
+    for user in list(credits_index().get(chat_id, ())):
+        mark_dirty("User", user)
+        del dt.users[user].debit[chat_id]
+        unindex_debit(user, chat_id)
 
 
 def get_slots(chat_id):
@@ -178,7 +670,7 @@ def get_slots(chat_id):
     :param chat_id: The chat_id of the driver.
     :return: An integer, representing the number of available slots.
     """
-    return dt.drivers[chat_id]["Slots"]
+    return dt.drivers[chat_id].slots
 
 
 # Trip multipli
@@ -204,6 +696,7 @@ def all_directions():
 # Trip singolo
 
 
+@mutator
 def new_trip(direction, day, driver, time):
     """
     Adds a new trip to the system.
@@ -213,11 +706,13 @@ def new_trip(direction, day, driver, time):
     :param time: The time of departure.
     :return:
     """
-    dt.groups[direction][day][driver] = {"Time": time,
-                                         "Permanent": [],
-                                         "Temporary": [],
-                                         "SuspendedUsers": [],
-                                         "Suspended": False}
+    driver = intern(driver)
+    unindex_trip(direction, day, driver)
+    unindex_departure(direction, day, driver)
+    mark_dirty("Trip", direction, day, driver)
+    dt.groups[direction][day][driver] = Trip(time)
+    index_departure(direction, day, driver)
+    index_search(direction, day, driver)
 
 
 def get_trip(direction, day, driver):
@@ -243,7 +738,7 @@ def get_time(direction, day, driver):
     :return: A string representing the departure time, formatted as %H:%M (24h)
     """
     try:
-        return dt.groups[direction][day][driver]["Time"]
+        return dt.groups[direction][day][driver].time
     except KeyError:
         return None
 
@@ -257,11 +752,12 @@ def is_suspended(direction, day, driver):
     :return: True if the trip is suspended.
     """
     try:
-        return dt.groups[direction][day][driver]["Suspended"]
+        return dt.groups[direction][day][driver].suspended
     except KeyError:
         return None
 
 
+@mutator
 def suspend_trip(direction, day, driver):
     """
     Suspends a given trip.
@@ -270,9 +766,11 @@ def suspend_trip(direction, day, driver):
     :param driver: The chat_id of the driver.
     :return:
     """
-    dt.groups[direction][day][driver]["Suspended"] = True
+    mark_dirty("Trip", direction, day, driver)
+    dt.groups[direction][day][driver].suspended = True
 
 
+@mutator
 def unsuspend_trip(direction, day, driver):
     """
     Removes a trip from its suspension.
@@ -281,9 +779,11 @@ def unsuspend_trip(direction, day, driver):
     :param driver: The chat_id of the driver.
     :return:
     """
-    dt.groups[direction][day][driver]["Suspended"] = False
+    mark_dirty("Trip", direction, day, driver)
+    dt.groups[direction][day][driver].suspended = False
 
 
+@mutator
 def add_passenger(direction, day, driver, mode, chat_id):
     """
     Adds a passenger to a given trip.
@@ -294,9 +794,76 @@ def add_passenger(direction, day, driver, mode, chat_id):
     :param chat_id: The chat_id of the passenger.
     :return:
     """
-    dt.groups[direction][day][driver][mode].append(chat_id)
+    chat_id = intern(chat_id)
+    mark_dirty("Trip", direction, day, driver)
+    dt.groups[direction][day][driver].passengers(mode)[chat_id] = None
+    index_booking(chat_id, (direction, day, driver, mode))
+
+
+@mutator
+def reserve_seat(direction, day, driver, user, mode):
+    """
+    Books a passenger on a trip only if a seat is still free, checking and booking as a single step.
+    Since it is recorded as a mutation, the check is performed again if the save has to be replayed.
+    :param direction: "Salita" or "Discesa".
+    :param day: A day spanning the whole work week ("Lunedì"-"Venerdì").
+    :param driver: The chat_id of the driver.
+    :param user: The chat_id of the passenger.
+    :param mode: "Permanent" or "Temporary".
+    :return: The number of seats left, or None if the trip is full or the passenger already has a seat.
+    """
+    trip = dt.groups[direction][day][driver]
+    slots = dt.drivers[driver].slots
+
+    if trip.occupied_slots() >= slots or user in trip.permanent or user in trip.temporary:
+        return None
+
+    add_passenger(direction, day, driver, mode, user)
+    return slots - trip.occupied_slots()
+
+
+@mutator
+def suspend_booking(direction, day, driver, chat_id):
+    """
+    Moves a permanent booking to the suspended ones, freeing its seat.
+    :param direction: "Salita" or "Discesa".
+    :param day: A day spanning the whole work week ("Lunedì"-"Venerdì").
+    :param driver: The chat_id of the driver.
+    :param chat_id: The chat_id of the passenger.
+    :raises: KeyError if the booking is not permanent
+    :return:
+    """
+    remove_passenger(direction, day, driver, "Permanent", chat_id)
+    add_passenger(direction, day, driver, "SuspendedUsers", chat_id)
+
+
+@mutator
+def restore_suspended_booking(direction, day, driver, chat_id):
+    """
+    Moves a suspended booking back to the permanent ones only if a seat is still free, checking and moving
+    as a single step.
+    :param direction: "Salita" or "Discesa".
+    :param day: A day spanning the whole work week ("Lunedì"-"Venerdì").
+    :param driver: The chat_id of the driver.
+    :param chat_id: The chat_id of the passenger.
+    :raises: KeyError if the booking is not suspended
+    :return: The number of seats left, or None if the trip is full.
+    """
+    trip = dt.groups[direction][day][driver]
+    slots = dt.drivers[driver].slots
+
+    if chat_id not in trip.suspended_users:
+        raise KeyError(chat_id)
+
+    if trip.occupied_slots() >= slots:
+        return None
 
+    remove_passenger(direction, day, driver, "SuspendedUsers", chat_id)
+    add_passenger(direction, day, driver, "Permanent", chat_id)
+    return slots - trip.occupied_slots()
 
+
+@mutator
 def remove_passenger(direction, day, driver, mode, chat_id):
     """
     Removes a passenger from a given trip.
@@ -308,9 +875,12 @@ def remove_passenger(direction, day, driver, mode, chat_id):
     :raises: KeyError
     :return:
     """
-    dt.groups[direction][day][driver][mode].remove(chat_id)
+    mark_dirty("Trip", direction, day, driver)
+    del dt.groups[direction][day][driver].passengers(mode)[chat_id]
+    unindex_booking(chat_id, (direction, day, driver, mode))
 
 
+@mutator
 def remove_trip(direction, day, driver):
     """
     Removes a trip from the system.
@@ -319,87 +889,155 @@ def remove_trip(direction, day, driver):
     :param driver: The chat_id of the driver.
     :return:
     """
+    unindex_trip(direction, day, driver)
+    unindex_departure(direction, day, driver)
+    unindex_search(direction, day, driver)
+    mark_dirty("Trip", direction, day, driver)
     del dt.groups[direction][day][driver]
 
 
+@mutator
+def set_time(direction, day, driver, time):
+    """
+    Changes the time of departure of a given trip.
+    :param direction: "Salita" or "Discesa".
+    :param day: A day spanning the whole work week ("Lunedì"-"Venerdì").
+    :param driver: The chat_id of the driver.
+    :param time: The new time of departure, formatted as %H:%M (24h).
+    :return:
+    """
+    unindex_departure(direction, day, driver)
+    mark_dirty("Trip", direction, day, driver)
+    dt.groups[direction][day][driver].time = time
+    index_departure(direction, day, driver)
+
+
+@mutator
+def set_location(direction, day, driver, location):
+    """
+    Sets the meeting point of a given trip.
+    :param direction: "Salita" or "Discesa".
+    :param day: A day spanning the whole work week ("Lunedì"-"Venerdì").
+    :param driver: The chat_id of the driver.
+    :param location: A key of common.locations.
+    :return:
+    """
+    mark_dirty("Trip", direction, day, driver)
+    dt.groups[direction][day][driver].location = location
+
+
+@mutator
+def remove_location(direction, day, driver):
+    """
+    Removes the meeting point of a given trip, if present.
+    :param direction: "Salita" or "Discesa".
+    :param day: A day spanning the whole work week ("Lunedì"-"Venerdì").
+    :param driver: The chat_id of the driver.
+    :return:
+    """
+    if dt.groups[direction][day][driver].location is not None:
+        mark_dirty("Trip", direction, day, driver)
+        dt.groups[direction][day][driver].location = None
+
+
+@mutator
+def clear_temporary(direction, day, driver):
+    """
+    Removes all the temporary bookings of a given trip.
+    :param direction: "Salita" or "Discesa".
+    :param day: A day spanning the whole work week ("Lunedì"-"Venerdì").
+    :param driver: The chat_id of the driver.
+    :return:
+    """
+    for person in dt.groups[direction][day][driver].temporary:
+        unindex_booking(person, (direction, day, driver, "Temporary"))
+    mark_dirty("Trip", direction, day, driver)
+    dt.groups[direction][day][driver].temporary = {}
+
+
 # Comandi avanzati
 
 
 def get_bookings(person):
     """Ritorna tutte le prenotazioni di una certa persona"""
-    return [(direction, day, driver, mode, dt.groups[direction][day][driver]["Time"])
-            for direction in ("Salita", "Discesa")
-            for day in work_days
-            for driver in dt.groups[direction][day]
-            for mode in dt.groups[direction][day][driver]
-            if (mode == "Permanent" or mode == "Temporary" or mode == "SuspendedUsers")
-            and person in dt.groups[direction][day][driver][mode]]
+    directions = ("Salita", "Discesa")
+    with lock.reading():
+        bookings = [(direction, day, driver, mode, dt.groups[direction][day][driver].time)
+                    for direction, day, driver, mode in bookings_index().get(person, ())
+                    if direction in directions and day in work_days]
+
+    # Stesso ordine di direzioni, giorni e modalità della visualizzazione dei viaggi
+    return sorted(bookings, key=lambda booking: (directions.index(booking[0]), work_days.index(booking[1]),
+                                                 Trip.MODES.index(booking[3])))
 
 
 def get_bookings_day_nosusp(person, day):
-    return [(direction, driver, mode, dt.groups[direction][day][driver]["Time"])
-            for direction in ("Salita", "Discesa")
-            for driver in dt.groups[direction][day]
-            if not dt.groups[direction][day][driver]["Suspended"]
-            for mode in dt.groups[direction][day][driver]
-            if (mode == "Permanent" or mode == "Temporary")
-            and person in dt.groups[direction][day][driver][mode]]
+    directions = ("Salita", "Discesa")
+    with lock.reading():
+        bookings = [(direction, driver, mode, dt.groups[direction][day][driver].time)
+                    for direction, booking_day, driver, mode in bookings_index().get(person, ())
+                    if booking_day == day and direction in directions and mode != "SuspendedUsers"
+                    and not dt.groups[direction][day][driver].suspended]
+
+    return sorted(bookings, key=lambda booking: (directions.index(booking[0]), Trip.MODES.index(booking[2])))
 
 
 def get_credits(input_creditor):
     """Restituisce un array di tuple contenente, dato un creditore, gli ID dei debitori e il valore."""
-    return [(user, dt.users[user]["Debit"][creditor]) for user in dt.users
-            for creditor in dt.users[user]["Debit"] if creditor == input_creditor]
+    with lock.reading():
+        return [(user, dt.users[user].debit[input_creditor]) for user in credits_index().get(input_creditor, ())]
 
 
 def get_debit_tuple(input_debitor):
     """Restituisce un array di tuple contenente, dato un debitore, gli ID dei creditore e il valore."""
-    return [(creditor, dt.users[input_debitor]["Debit"][creditor])
-            for creditor in dt.users[input_debitor]["Debit"]]
-
-
-def get_new_debitors(chat_id):
-    # Resituisce una lista di tuple del tipo (Nome, ID)
-    return sorted([
-        (
-            dt.users[user]["Name"],
-            user
-        )
-        for user in dt.users
-        if user != chat_id and chat_id not in dt.users[user]["Debit"]
-    ])
-
-
-def get_new_passengers(chat_id):
-    # Resituisce una lista di tuple del tipo (Nome, ID)
-    return sorted([
-        (
-            dt.users[user]["Name"],
-            user
-        )
-        for user in dt.users
-        if user != chat_id
-    ])
+    with lock.reading():
+        return [(creditor, dt.users[input_debitor].debit[creditor])
+                for creditor in dt.users[input_debitor].debit]
+
+
+def get_new_debitors(chat_id, page):
+    # Restituisce una pagina di tuple del tipo (Nome, ID), escludendo chi ha già un debito, e il numero di pagine
+    return get_users_page(page, [chat_id, *credits_index().get(chat_id, ())])
+
+
+def get_new_passengers(chat_id, page):
+    # Restituisce una pagina di tuple del tipo (Nome, ID) e il numero di pagine
+    return get_users_page(page, [chat_id])
 
 
 def get_all_trips_fixed_direction(direction, day):
-    return sorted([
-        (
-            dt.groups[direction][day][driver]["Time"],  # Orario di partenza
-            driver  # Chat ID dell'autista
-        )
-        for driver in dt.groups[direction][day]
-        if not dt.groups[direction][day][driver]["Suspended"]
-    ])
+    # Restituisce una lista di tuple del tipo (ora, guidatore), ordinata per orario, dei viaggi non sospesi
+    trips = dt.groups[direction][day]
+    return [(trips[driver].time, driver)
+            for minutes, driver in departures_index().get((direction, day), ())
+            if not trips[driver].suspended]
 
 
 def get_all_trips_day(day):
-    return sorted([
-        # Restituisce una tupla del tipo (ora, guidatore, direzione, chat_id) riordinata
-        (
-            dt.groups[direction][day][driver]["Time"],
-            dt.users[driver]["Name"], direction, driver
-        )
-        for direction in dt.groups
-        for driver in dt.groups[direction][day]
-    ])
+    # Restituisce una lista di tuple del tipo (ora, guidatore, direzione, chat_id) ordinata per orario
+    index = departures_index()
+    departures = heapq.merge(*([(minutes, direction, driver) for minutes, driver in index.get((direction, day), ())]
+                               for direction in dt.groups))
+    return [(dt.groups[direction][day][driver].time, dt.users[driver].name, direction, driver)
+            for minutes, direction, driver in departures]
+
+
+def search_trips(query):
+    # Restituisce una lista di tuple del tipo (direzione, giorno, autista) dei viaggi dei giorni lavorativi
+    # in cui ogni parola della ricerca è l'inizio di una parola del giorno o del nome dell'autista,
+    # ordinata per giorno, direzione e orario
+    index = search_index()
+    directions = list(dt.groups)
+
+    def order(trip):
+        # I viaggi con un orario non valido vanno in fondo al proprio giorno
+        minutes = departure_minutes(*trip)
+        return work_days.index(trip[1]), directions.index(trip[0]), math.inf if minutes is None else minutes
+
+    with lock.reading(), index_lock:
+        groups = sorted((index.get(word, {}) for word in set(query.lower().split())), key=len)
+        if not groups:
+            return []
+
+        trips = [trip for trip in groups[0] if trip[1] in work_days and all(trip in group for group in groups[1:])]
+        return sorted(trips, key=order)
@@ -1,58 +1,677 @@
 # -*- coding: utf-8 -*-
 
+import atexit
 import logging as log
+import marshal
+import os
+import threading
+import time
+from contextlib import contextmanager
 
-from google.cloud import datastore
+from data import codec, dataset, model
+from data.storage import storage, Conflict
+from util import common
+from util.common import days
 
-from data import dataset
+# Entità modificate dall'ultimo salvataggio, nella forma ("User", chat_id), ("Driver", chat_id)
+# oppure ("Trip", direction, day, driver)
+dirty = set()
 
+# Modifiche (nome della funzione di data_api e argomenti) non ancora salvate, da riapplicare in caso di conflitto
+pending = []
 
-def dump_data():
-    """Dumps the whole dataset to Cloud Datastore"""
-    if not empty_dataset():
-        import json
-        client = datastore.Client()
-        key = client.key("Data", 1)
-        client.delete(key)
-
-        # Prepares the new entity
-        data = datastore.Entity(key=key, exclude_from_indexes=("groups", "users", "drivers"))
-        data["groups"] = json.dumps(dataset.groups)
-        data["users"] = json.dumps(dataset.users)
-        data["drivers"] = json.dumps(dataset.drivers)
-
-        # Saves the entity
-        client.put(data)
-        return True
+
+class RWLock:
+    """
+    Reentrant reader/writer lock. Used as a context manager it is acquired exclusively, like an RLock, while
+    reading() acquires it in shared mode, so that any number of readers can hold it at the same time.
+    Waiting writers have precedence over new readers. The thread holding the lock exclusively can also
+    read, but a reader cannot acquire the lock exclusively.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition(threading.Lock())
+        self.writer = None
+        self.depth = 0
+        self.readers = {}
+        self.waiting = 0
+
+    def __enter__(self):
+        me = threading.get_ident()
+        with self.condition:
+            if self.writer == me:
+                self.depth += 1
+                return self
+
+            if me in self.readers:
+                raise RuntimeError("Cannot acquire exclusively a lock held for reading")
+
+            self.waiting += 1
+            try:
+                while self.writer is not None or self.readers:
+                    self.condition.wait()
+            finally:
+                self.waiting -= 1
+
+            self.writer = me
+            self.depth = 1
+            return self
+
+    def __exit__(self, *args):
+        with self.condition:
+            self.depth -= 1
+            if self.depth == 0:
+                self.writer = None
+                self.condition.notify_all()
+
+    @contextmanager
+    def reading(self):
+        me = threading.get_ident()
+        with self.condition:
+            if self.writer == me:
+                shared = False
+            else:
+                # Un thread che sta già leggendo non aspetta gli scrittori, altrimenti si bloccherebbe da solo
+                while me not in self.readers and (self.writer is not None or self.waiting):
+                    self.condition.wait()
+                self.readers[me] = self.readers.get(me, 0) + 1
+                shared = True
+
+        try:
+            yield
+        finally:
+            if shared:
+                with self.condition:
+                    self.readers[me] -= 1
+                    if not self.readers[me]:
+                        del self.readers[me]
+                        self.condition.notify_all()
+
+    @contextmanager
+    def released(self):
+        """Releases the lock held by the current thread, if any, for the duration of the block, then takes it back"""
+        me = threading.get_ident()
+        with self.condition:
+            depth = self.depth if self.writer == me else 0
+            count = self.readers.pop(me, 0)
+            if depth:
+                self.writer = None
+                self.depth = 0
+            if depth or count:
+                self.condition.notify_all()
+
+        try:
+            yield
+        finally:
+            with self.condition:
+                if depth:
+                    self.waiting += 1
+                    try:
+                        while self.writer is not None or self.readers:
+                            self.condition.wait()
+                    finally:
+                        self.waiting -= 1
+                    self.writer = me
+                    self.depth = depth
+                elif count:
+                    while self.writer is not None or self.waiting:
+                        self.condition.wait()
+                    self.readers[me] = count
+
+
+# Lock tenuto in modo esclusivo durante le modifiche al dataset (vedi data_api.mutator), il caricamento dei
+# dati, l'elaborazione degli update (vedi routing.webhook.shard_loop) e i cron (vedi main), e in modo condiviso
+# dagli handler che leggono soltanto (vedi routing.filters.read_only). Viene rilasciato durante le chiamate alla
+# Bot API, vedi unlocked
+lock = RWLock()
+
+
+class Sync:
+    """
+    Version of the saved data the in-memory dataset is based on, and version of the last snapshot. unsnapshotted
+    contains the items changed by the log records following the snapshot, which the next compaction has to save.
+    generation is incremented whenever the dataset is changed without going through data_api (loads and log
+    records of other instances), so that the indexes of data_api know when to rebuild themselves.
+    """
+    version = 0
+    snapshot = 0
+    unsnapshotted = set()
+    generation = 0
+
+
+class LocalSnapshot:
+    """Format of the local snapshot file: change it whenever the saved fields change"""
+    format = 1
+
+
+class Undo:
+    """
+    Values of the items modified by the running data_api.transaction, as they were before their first change,
+    in the saved format (None for the items that did not exist). entries is None outside of transactions.
+    """
+    entries = None
+
+
+class Flusher:
+    """Background thread saving the dataset every FLUSH_INTERVAL seconds or after FLUSH_THRESHOLD changes"""
+    thread = None
+    wake = threading.Event()
+    stopping = False
+    changes = 0
+
+
+@contextmanager
+def unlocked():
+    """
+    Releases the dataset lock held by the current thread during slow operations, like the calls to the Bot API,
+    so that other threads can use the dataset meanwhile. Inside a transaction the lock is kept, so that the
+    transaction stays isolated.
+
+    Since every Bot API call goes through unlocked, the dataset can change at each call. Code that sends messages
+    while walking the dataset, in the handlers as in the cron jobs, iterates over a copy taken before the first
+    call, and reads again through data_api whatever it needs after a call instead of reusing the values read
+    before it. Decisions that depend on the current state belong in a mutator, which checks it under the lock.
+    """
+    if Undo.entries is not None:
+        yield
     else:
+        with lock.released():
+            yield
+
+
+def mark_dirty(kind, *key):
+    """
+    Marks a single user, driver or trip as modified, so that the next dump_data saves it.
+    MUST BE called before modifying it, so that the running transaction can restore it.
+    """
+    item = (kind, *key)
+    if Undo.entries is not None and item not in Undo.entries:
+        Undo.entries[item] = model.to_dict(get_item(item))
+
+    dirty.add(item)
+
+    Flusher.changes += 1
+    if Flusher.changes >= common.FLUSH_THRESHOLD:
+        Flusher.wake.set()
+
+
+def record_mutation(name, args, kwargs):
+    """Records a data_api mutation, so that it can be replayed if the save conflicts with another instance"""
+    pending.append((name, args, kwargs))
+
+
+def dump_data(full=False):
+    """
+    Appends the modified users, drivers and trips to the log of the storage backend, compacting it into the
+    snapshot when enough records have accumulated. If full is True, everything is saved and compacted.
+    """
+    if empty_dataset():
         log.critical("Trying to save empty data!")
         return False
 
+    if full:
+        with lock:
+            # Il salvataggio completo viene usato anche per caricare i dati di secrets.py, salvati come dizionari
+            dataset.groups, dataset.users, dataset.drivers = from_dicts(dataset.groups, dataset.users,
+                                                                       dataset.drivers)
+            dirty.update(all_items())
+
+    saved = False
+    for attempt in range(common.MAX_ATTEMPTS):
+        with lock:
+            if not dirty:
+                # Nessuna modifica, evito il round trip verso il backend
+                break
+
+            items = list(dirty)
+            mutations = list(pending)
+            dirty.clear()
+            pending.clear()
+            Flusher.changes = 0
+            version = Sync.version
+
+            # Ogni record contiene sia le modifiche logiche, per la cronologia, sia il nuovo valore delle
+            # entità modificate, così che riapplicarlo al caricamento dia sempre lo stesso risultato
+            record = codec.encode({
+                "Time": int(time.time()),
+                "Ops": [[name, list(args), kwargs] for name, args, kwargs in mutations],
+                "Changes": [[item[0], item_name(item), model.to_dict(get_item(item))] for item in items]
+            })
+
+        start = time.perf_counter()
+        try:
+            new_version = storage().append(record, version)
+        except Conflict:
+            # Un'altra istanza ha salvato nel frattempo: ricarico i dati e riapplico le modifiche
+            log.warning(f"Save conflict on version {version}, replaying {len(mutations)} mutations")
+            with lock:
+                pending[:0] = mutations
+                replay_on_fresh_data()
+            continue
+        except Exception:
+            with lock:
+                dirty.update(items)
+                pending[:0] = mutations
+            raise
+
+        with lock:
+            if Sync.version == version:
+                Sync.version = new_version
+                Sync.unsnapshotted.update(items)
+
+        log.info(f"Saved {len(items)} entities (version {new_version}, {len(record)} bytes) in "
+                 f"{(time.perf_counter() - start) * 1000:.1f} ms")
+        saved = True
+        break
+    else:
+        log.critical("Failed to save data: too many conflicts")
+        return False
+
+    # La compattazione avviene anche quando lo snapshot è aggiornato ma contiene entità da riscrivere
+    # (migrazione dai formati precedenti)
+    if Sync.unsnapshotted and (full or Sync.version - Sync.snapshot >= common.COMPACT_THRESHOLD or
+                               Sync.version == Sync.snapshot):
+        saved = compact_data() or saved
+
+    if saved:
+        save_local_snapshot()
+
+    return True
+
+
+def compact_data():
+    """
+    Saves the items changed since the last snapshot in the snapshot of the storage backend, so that the log
+    records before the current version no longer need to be loaded. The records are kept as a history.
+    """
+    with lock:
+        if dirty or pending:
+            # Modifiche non ancora salvate: i valori in memoria non corrispondono a nessuna versione
+            return False
+
+        items = list(Sync.unsnapshotted)
+        version = Sync.version
+
+        puts, deletes = [], []
+        for item in items:
+            value = get_item(item)
+
+            if value is None:
+                deletes.append((item[0], item_name(item)))
+            else:
+                puts.append((item[0], item_name(item), codec.encode(value.to_dict())))
+
+    start = time.perf_counter()
+    try:
+        storage().compact(puts, deletes, version)
+    except Conflict as ex:
+        # Un'altra istanza sta compattando, o ha già compattato una versione più recente
+        log.info(f"Skipped compaction of version {version}: {ex}")
+        return False
+
+    with lock:
+        Sync.unsnapshotted.difference_update(items)
+        Sync.snapshot = max(Sync.snapshot, version)
+
+    log.info(f"Compacted {len(puts)} saved and {len(deletes)} deleted entities into the snapshot of version "
+             f"{version} in {(time.perf_counter() - start) * 1000:.1f} ms")
+    return True
+
+
+def replay_on_fresh_data():
+    """
+    Replaces the dataset with the latest saved version and applies again every pending mutation.
+    MUST BE called while holding the lock.
+    """
+    from data import data_api
+
+    mutations = list(pending)
+    pending.clear()
+    dirty.clear()
+
+    load_dataset()
+
+    for name, args, kwargs in mutations:
+        try:
+            result = getattr(data_api, name)(*args, **kwargs)
+        except Exception as ex:
+            # La modifica non è più applicabile (es. il viaggio è stato cancellato da un'altra istanza)
+            log.warning(f"Dropped mutation {name}{args}: {ex!r}")
+            continue
+
+        if result is None and name in data_api.SEAT_MUTATIONS:
+            # Il posto era libero quando il passeggero è stato avvisato, ma un'altra istanza l'ha occupato prima
+            log.error(f"Replayed {name}{args} found the trip full: the passenger was told the seat was booked")
+
+
+def flush_loop():
+    """Body of the flusher thread: waits for the interval or the change threshold, then saves"""
+    while not Flusher.stopping:
+        Flusher.wake.wait(common.FLUSH_INTERVAL)
+        Flusher.wake.clear()
+
+        try:
+            dump_data()
+        except Exception as ex:
+            log.critical("Failed to save data!")
+            log.critical(ex)
+
+
+def start_flusher():
+    """Starts the write-behind flusher, which also saves any pending change when the instance shuts down"""
+    if Flusher.thread is not None:
+        return
+
+    Flusher.thread = threading.Thread(target=flush_loop, name="flusher", daemon=True)
+    Flusher.thread.start()
+    atexit.register(stop_flusher)
+
+
+def stop_flusher():
+    """Stops the flusher and saves synchronously whatever is still pending"""
+    if Flusher.thread is None:
+        return
+
+    Flusher.stopping = True
+    Flusher.wake.set()
+    Flusher.thread.join(common.FLUSH_INTERVAL)
+    Flusher.thread = None
+
+    try:
+        dump_data()
+    except Exception as ex:
+        log.critical("Failed to save data on shutdown!")
+        log.critical(ex)
+
 
 def get_data():
-    """Gets the data from Cloud Datastore"""
+    """Gets the data from the storage backend"""
     if not empty_dataset():
         return False
 
-    import json
     try:
-        client = datastore.Client()
-        json_data = client.get(client.key("Data", 1))
+        with lock:
+            if load_local_snapshot():
+                return True
+
+            outcome = load_dataset()
+    except Exception as ex:
+        log.critical(ex)
+        return False
+
+    if outcome:
+        save_local_snapshot()
+    return outcome
+
+
+def refresh_data():
+    """
+    Brings the in-memory dataset up to date with the storage backend. Only the version is read, unless
+    another instance has saved in the meantime: in that case only the new log records are loaded.
+    """
+    if empty_dataset():
+        return get_data()
+
+    try:
+        version = Sync.version
+        latest = storage().get_version()
+        if latest == version:
+            return True
+
+        with lock:
+            local_changes = bool(dirty or pending)
 
-        dataset.groups = json.loads(json_data["groups"])
-        dataset.users = json.loads(json_data["users"])
-        dataset.drivers = json.loads(json_data["drivers"])
+        if local_changes:
+            # Il salvataggio andrà in conflitto, ricaricando i dati e riapplicando le modifiche locali
+            return dump_data()
 
-        log.info(str(json_data["groups"]))
-        log.info(str(json_data["users"]))
-        log.info(str(json_data["drivers"]))
+        start = time.perf_counter()
+        records = storage().load_log(version)
+        versions = [record_version for record_version, data in records]
 
+        with lock:
+            if dirty or pending or Sync.version != version:
+                # I dati sono cambiati durante la lettura: se ne occuperà il prossimo salvataggio
+                return False
+
+            if versions != list(range(version + 1, version + 1 + len(records))):
+                # Record mancanti, per esempio dopo un ripristino del backend: ricarico tutto
+                return load_dataset()
+
+            for record_version, data in records:
+                Sync.unsnapshotted.update(apply_record(data, dataset.groups, dataset.users, dataset.drivers))
+                Sync.version = record_version
+            Sync.generation += 1
+
+        log.info(f"Applied {len(records)} log records (version {version} to {Sync.version}) in "
+                 f"{(time.perf_counter() - start) * 1000:.1f} ms")
+        save_local_snapshot()
         return True
     except Exception as ex:
         log.critical(ex)
         return False
 
 
+def load_dataset():
+    """
+    Loads the snapshot and the following log records from the storage backend, replacing the in-memory dataset.
+    MUST BE called while holding the lock.
+    """
+    groups = {direction: {day: {} for day in days} for direction in ("Salita", "Discesa")}
+    users, drivers = {}, {}
+    unsnapshotted = set()
+
+    start = time.perf_counter()
+    version, snapshot, entities, records = storage().load()
+
+    for kind, name, data in entities:
+        item = parse_item(kind, name)
+        if item is None:
+            continue
+
+        set_item(item, codec.decode(data), groups, users, drivers)
+
+    for record_version, data in records:
+        unsnapshotted.update(apply_record(data, groups, users, drivers))
+
+    if users:
+        dataset.groups, dataset.users, dataset.drivers = groups, users, drivers
+        Sync.version, Sync.snapshot, Sync.unsnapshotted = version, snapshot, unsnapshotted
+        Sync.generation += 1
+        log.info(f"Loaded {len(users)} users, {len(drivers)} drivers and {len(records)} log records "
+                 f"(version {version}) in {(time.perf_counter() - start) * 1000:.1f} ms")
+        return True
+
+    # Nessuna entità: provo a migrare i dati salvati in un unico blocco
+    legacy = storage().load_legacy()
+    if legacy is None:
+        return False
+
+    dataset.groups, dataset.users, dataset.drivers = from_dicts(*(codec.decode(section) for section in legacy))
+    Sync.version, Sync.snapshot, Sync.unsnapshotted = version, snapshot, set(all_items())
+    Sync.generation += 1
+    log.info("Migrating legacy data to per-entity layout")
+    return True
+
+
+def save_local_snapshot():
+    """
+    Saves the in-memory dataset and its version to common.LOCAL_SNAPSHOT_PATH, so that a restarted instance
+    can start from it instead of loading everything from the storage backend.
+    """
+    if not common.LOCAL_SNAPSHOT_PATH:
+        return
+
+    with lock.reading():
+        if dirty or pending:
+            # I valori in memoria non corrispondono a nessuna versione salvata
+            return
+
+        data = marshal.dumps({
+            "Format": LocalSnapshot.format,
+            "Storage": common.STORAGE,
+            "Version": Sync.version,
+            "Snapshot": Sync.snapshot,
+            "Unsnapshotted": Sync.unsnapshotted,
+            "Groups": {direction: {day: {driver: trip.to_dict() for driver, trip in trips.items()}
+                                   for day, trips in group.items()}
+                       for direction, group in dataset.groups.items()},
+            "Users": {chat_id: user.to_dict() for chat_id, user in dataset.users.items()},
+            "Drivers": {chat_id: driver.to_dict() for chat_id, driver in dataset.drivers.items()}
+        })
+
+    # Scrivo su un file temporaneo e lo rinomino, così che un crash non lasci mai un file a metà
+    temp_path = f"{common.LOCAL_SNAPSHOT_PATH}.{threading.get_ident()}"
+    try:
+        with open(temp_path, "wb") as file:
+            file.write(data)
+        os.replace(temp_path, common.LOCAL_SNAPSHOT_PATH)
+    except OSError as ex:
+        log.warning(f"Failed to save local snapshot: {ex}")
+
+
+def load_local_snapshot():
+    """
+    Loads the dataset from common.LOCAL_SNAPSHOT_PATH, applying the log records saved after it.
+    MUST BE called while holding the lock.
+    :return: True if the local snapshot was valid and has been loaded.
+    """
+    if not common.LOCAL_SNAPSHOT_PATH or not os.path.exists(common.LOCAL_SNAPSHOT_PATH):
+        return False
+
+    start = time.perf_counter()
+    try:
+        with open(common.LOCAL_SNAPSHOT_PATH, "rb") as file:
+            data = marshal.load(file)
+
+        if data.get("Format") != LocalSnapshot.format or data.get("Storage") != common.STORAGE:
+            return False
+
+        version = data["Version"]
+        latest = storage().get_version()
+        if latest < version:
+            # Il backend è stato ripristinato o sostituito: lo snapshot locale non è più valido
+            log.warning(f"Local snapshot of version {version} is newer than the saved version {latest}")
+            return False
+
+        records = storage().load_log(version) if latest > version else []
+        if [record_version for record_version, record in records] != list(range(version + 1,
+                                                                                  version + 1 + len(records))):
+            return False
+
+        groups, users, drivers = from_dicts(data["Groups"], data["Users"], data["Drivers"])
+        unsnapshotted = data["Unsnapshotted"]
+        for record_version, record in records:
+            unsnapshotted.update(apply_record(record, groups, users, drivers))
+            version = record_version
+    except Exception as ex:
+        log.warning(f"Failed to load local snapshot: {ex!r}")
+        return False
+
+    if not users:
+        return False
+
+    dataset.groups, dataset.users, dataset.drivers = groups, users, drivers
+    Sync.version, Sync.snapshot, Sync.unsnapshotted = version, data["Snapshot"], unsnapshotted
+    Sync.generation += 1
+    log.info(f"Loaded {len(users)} users, {len(drivers)} drivers from the local snapshot and {len(records)} "
+             f"log records (version {version}) in {(time.perf_counter() - start) * 1000:.1f} ms")
+    return True
+
+
+def all_items():
+    """Returns every user, driver and trip of the dataset, in the same form used by mark_dirty"""
+    items = [("User", chat_id) for chat_id in dataset.users]
+    items += [("Driver", chat_id) for chat_id in dataset.drivers]
+    items += [("Trip", direction, day, driver)
+              for direction in dataset.groups
+              for day in dataset.groups[direction]
+              for driver in dataset.groups[direction][day]]
+    return items
+
+
+def item_name(item):
+    """Returns the name of the saved entity of a given item"""
+    return "/".join(str(part) for part in item[1:])
+
+
+def apply_record(data, groups, users, drivers):
+    """
+    Applies a log record to the given dataset sections.
+    :param data: The serialized record.
+    :return: The list of the items changed by the record.
+    """
+    items = []
+
+    for kind, name, value in codec.decode(data)["Changes"]:
+        item = parse_item(kind, name)
+        if item is not None:
+            set_item(item, value, groups, users, drivers)
+            items.append(item)
+
+    return items
+
+
+def set_item(item, value, groups, users, drivers):
+    """
+    Sets the value of a given item in the given dataset sections.
+    :param value: The saved dictionary of the user, driver or trip, or None to delete it.
+    """
+    if item[0] == "User":
+        section, key = users, item[1]
+    elif item[0] == "Driver":
+        section, key = drivers, item[1]
+    else:
+        section, key = groups[item[1]].setdefault(item[2], {}), item[3]
+
+    if value is None:
+        section.pop(key, None)
+    else:
+        section[model.intern(key)] = model.from_dict(item[0], value)
+
+
+def from_dicts(groups, users, drivers):
+    """
+    Converts the dataset sections from the saved format to the classes of data/model.py.
+    Values that have already been converted are left as they are.
+    :return: A (groups, users, drivers) tuple.
+    """
+    def convert(kind, section):
+        return {model.intern(key): model.from_dict(kind, value) if isinstance(value, dict) else value
+                for key, value in section.items()}
+
+    return ({direction: {day: convert("Trip", trips) for day, trips in groups[direction].items()}
+             for direction in groups},
+            convert("User", users),
+            convert("Driver", drivers))
+
+
+def parse_item(kind, name):
+    """Returns the item of a saved entity given its kind and name, or None if the kind is unknown"""
+    if kind in ("User", "Driver"):
+        return kind, name
+    elif kind == "Trip":
+        return (kind, *name.split("/"))
+    else:
+        return None
+
+
+def get_item(item):
+    """Returns the current value of a given item, or None if it was deleted"""
+    kind = item[0]
+
+    if kind == "User":
+        return dataset.users.get(item[1])
+    elif kind == "Driver":
+        return dataset.drivers.get(item[1])
+    else:
+        direction, day, driver = item[1:]
+        try:
+            return dataset.groups[direction][day].get(driver)
+        except KeyError:
+            return None
+
+
 def print_data():
     """Prints to the Cloud Console Logs the current dataset. MUST BE used after get_data"""
     log.info("Drivers: " + str(dataset.drivers))
@@ -63,8 +682,8 @@ def print_data():
 
 
 def empty_datastore():
-    """Verifies that the Cloud Datastore is empty"""
-    return datastore.Client().get(datastore.Client().key("Data", 1)) is None
+    """Verifies that the storage backend is empty"""
+    return storage().is_empty()
 
 
 def empty_dataset():
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+
+import sys
+
+#
+# Classi usate in memoria per utenti, autisti e viaggi. Le prenotazioni di un viaggio sono dizionari con
+# valori None, usati come insiemi ordinati. I chat_id vengono internati, così che ogni id sia salvato una
+# sola volta e i confronti siano più veloci. to_dict e from_dict convertono nel formato salvato dai
+# backend, che resta quello a dizionari delle versioni precedenti.
+#
+
+
+def intern(chat_id):
+    """Interns a chat_id, converting it to a string if needed"""
+    return sys.intern(str(chat_id))
+
+
+class User:
+    __slots__ = ("name", "debit")
+
+    def __init__(self, name, debit=None):
+        self.name = name
+        self.debit = debit if debit is not None else {}
+
+    def to_dict(self):
+        return {"Name": self.name, "Debit": dict(self.debit)}
+
+    @staticmethod
+    def from_dict(data):
+        return User(data["Name"], {intern(creditor): value for creditor, value in data["Debit"].items()})
+
+    def __repr__(self):
+        return f"User({self.name!r}, {self.debit!r})"
+
+
+class Driver:
+    __slots__ = ("slots",)
+
+    def __init__(self, slots):
+        self.slots = slots
+
+    def to_dict(self):
+        return {"Slots": self.slots}
+
+    @staticmethod
+    def from_dict(data):
+        return Driver(data["Slots"])
+
+    def __repr__(self):
+        return f"Driver({self.slots!r})"
+
+
+class Trip:
+    __slots__ = ("time", "permanent", "temporary", "suspended_users", "suspended", "location")
+
+    # Modalità di prenotazione, con i nomi usati nel formato salvato e nelle callback
+    MODES = ("Permanent", "Temporary", "SuspendedUsers")
+
+    def __init__(self, time, permanent=None, temporary=None, suspended_users=None, suspended=False,
+                 location=None):
+        self.time = time
+        self.permanent = permanent if permanent is not None else {}
+        self.temporary = temporary if temporary is not None else {}
+        self.suspended_users = suspended_users if suspended_users is not None else {}
+        self.suspended = suspended
+        self.location = location
+
+    def passengers(self, mode):
+        """
+        Returns the bookings of a given mode.
+        :param mode: "Permanent", "Temporary" or "SuspendedUsers".
+        :raises: KeyError
+        :return: A dict used as an ordered set of chat_ids.
+        """
+        if mode == "Permanent":
+            return self.permanent
+        elif mode == "Temporary":
+            return self.temporary
+        elif mode == "SuspendedUsers":
+            return self.suspended_users
+        else:
+            raise KeyError(mode)
+
+    def occupied_slots(self):
+        """Returns the number of seats taken, suspended bookings excluded"""
+        return len(self.permanent) + len(self.temporary)
+
+    def to_dict(self):
+        data = {"Time": self.time,
+                "Permanent": list(self.permanent),
+                "Temporary": list(self.temporary),
+                "SuspendedUsers": list(self.suspended_users),
+                "Suspended": self.suspended}
+        if self.location is not None:
+            data["Location"] = self.location
+        return data
+
+    @staticmethod
+    def from_dict(data):
+        return Trip(data["Time"],
+                    dict.fromkeys(intern(user) for user in data["Permanent"]),
+                    dict.fromkeys(intern(user) for user in data["Temporary"]),
+                    dict.fromkeys(intern(user) for user in data["SuspendedUsers"]),
+                    data["Suspended"],
+                    data.get("Location"))
+
+    def __repr__(self):
+        return f"Trip({self.to_dict()!r})"
+
+
+# Classe corrispondente a ogni tipo di entità salvata
+KINDS = {"User": User, "Driver": Driver, "Trip": Trip}
+
+
+def from_dict(kind, data):
+    """
+    Builds a user, driver or trip from the saved format.
+    :param kind: "User", "Driver" or "Trip".
+    :param data: The saved dictionary, or None.
+    :return: The model object, or None if data is None.
+    """
+    return KINDS[kind].from_dict(data) if data is not None else None
+
+
+def to_dict(value):
+    """Converts a user, driver or trip to the saved format. None is left as is"""
+    return value.to_dict() if value is not None else None
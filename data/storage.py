@@ -0,0 +1,434 @@
+# -*- coding: utf-8 -*-
+
+import logging as log
+import threading
+import time
+import uuid
+
+from util import common
+
+
+#
+# In questo file sono presenti i backend di salvataggio usati da dumpable.py. Ogni backend salva:
+# - un log append-only, con un record per ogni salvataggio; il numero dell'ultimo record è la versione dei dati;
+# - uno snapshot, fatto di entità identificate da un tipo ("User", "Driver", "Trip") e da un nome, che
+#   contiene i dati fino a una certa versione del log; i record successivi vanno riapplicati sopra di esso.
+# Il contenuto di record ed entità è serializzato da dumpable.py. Il backend in uso si sceglie con common.STORAGE.
+#
+
+
+class Conflict(Exception):
+    """Raised when saving on top of a version that another instance has already replaced"""
+
+
+class Storage:
+    """Interface shared by every storage backend"""
+
+    def load(self):
+        """
+        Loads the snapshot and the part of the log that follows it.
+        :return: A (version, snapshot, entities, records) tuple. entities is an iterable of (kind, name, data) tuples
+        and data is what compact received; records is a list of (version, data) tuples sorted by version, with data
+        being what append received.
+        """
+        raise NotImplementedError
+
+    def get_version(self):
+        """
+        Reads the current version, without loading any data.
+        :return: The version.
+        """
+        raise NotImplementedError
+
+    def load_log(self, version):
+        """
+        Loads the log records following a given version.
+        :param version: The version the caller is up to date with.
+        :return: A list of (version, data) tuples sorted by version.
+        """
+        raise NotImplementedError
+
+    def append(self, record, version):
+        """
+        Appends a record to the log, only if the saved version is still the given one.
+        :param record: The serialized record.
+        :param version: The version the record is based on.
+        :raises: Conflict
+        :return: The new version.
+        """
+        raise NotImplementedError
+
+    def compact(self, puts, deletes, version):
+        """
+        Saves the entities changed since the last snapshot, making them the snapshot of the given version.
+        :param puts: A list of (kind, name, data) tuples to be saved.
+        :param deletes: A list of (kind, name) tuples to be deleted.
+        :param version: The version the entities are taken from.
+        :raises: Conflict, if a snapshot of a newer version exists or another instance is compacting.
+        :return:
+        """
+        raise NotImplementedError
+
+    def load_legacy(self):
+        """
+        Loads the dataset from a layout older than the per-entity one, if the backend had one.
+        :return: A (groups, users, drivers) tuple of JSON strings, or None.
+        """
+        return None
+
+    def is_empty(self):
+        """
+        :return: True if nothing has been saved yet.
+        """
+        raise NotImplementedError
+
+
+class DatastoreStorage(Storage):
+    """
+    Google Cloud Datastore backend. The snapshot entities are children of ROOT, which holds version and snapshot,
+    while the log records are children of LOG_ROOT, so that both can be loaded with a strongly consistent query.
+    Records larger than PART_BYTES are split into LogPart children of their Log entity.
+    """
+    ROOT = ("Dataset", 1)
+    LOG_ROOT = ("DatasetLog", 1)
+    LOCK = ("DatasetLock", 1)  # Presente solo durante le compattazioni troppo grandi per una transazione
+    BATCH_SIZE = 500  # Numero massimo di modifiche in una singola chiamata o transazione
+    BATCH_BYTES = 9000000  # Byte di dati scritti al massimo in una transazione (il limite di Datastore è 10 MiB)
+    PART_BYTES = 1000000  # Byte di dati per entità: i record più grandi vengono divisi (il limite è 1 MiB)
+    LEASE = 300  # Secondi dopo cui una compattazione interrotta smette di bloccare le altre
+
+    def __init__(self):
+        from google.cloud import datastore
+        self.datastore = datastore
+        self.client = datastore.Client()
+
+    def key(self, kind, name):
+        return self.client.key(kind, name, parent=self.client.key(*self.ROOT))
+
+    def load(self):
+        version, snapshot, entities = 0, 0, []
+
+        # L'entità radice, che contiene versione e snapshot, viene restituita dalla stessa query
+        for entity in self.client.query(ancestor=self.client.key(*self.ROOT)).fetch():
+            if entity.key.parent is None:
+                version = entity["version"]
+                snapshot = entity["snapshot"]
+            else:
+                entities.append((entity.key.kind, entity.key.name, entity["data"]))
+
+        records = self.load_log(snapshot)
+        if records:
+            # Record salvati da altre istanze tra le due query
+            version = max(version, records[-1][0])
+
+        return version, snapshot, entities, records
+
+    def get_version(self):
+        root = self.client.get(self.client.key(*self.ROOT))
+        return root["version"] if root is not None else 0
+
+    def load_log(self, version):
+        log_root = self.client.key(*self.LOG_ROOT)
+        query = self.client.query(kind="Log", ancestor=log_root)
+        if version > 0:
+            query.add_filter("__key__", ">", self.client.key("Log", version, parent=log_root))
+
+        entities = list(query.fetch())
+        parts = {}
+        if any(entity.get("parts", 1) > 1 for entity in entities):
+            # Record divisi in più entità: le parti successive alla prima sono figlie del record
+            query = self.client.query(kind="LogPart", ancestor=log_root)
+            if version > 0:
+                query.add_filter("__key__", ">=", self.client.key("Log", version + 1, parent=log_root))
+            for part in query.fetch():
+                parts.setdefault(part.key.parent.id, []).append((part.key.id, part["data"]))
+
+        records = []
+        for entity in entities:
+            data = entity["data"]
+            if entity.get("parts", 1) > 1:
+                following = sorted(parts.get(entity.key.id, []))
+                if len(following) != entity["parts"] - 1:
+                    raise ValueError(f"Log record {entity.key.id} is missing some of its parts")
+                data = b"".join([data] + [part for index, part in following])
+            records.append((entity.key.id, data))
+
+        return sorted(records)
+
+    def transaction(self):
+        """Opens a transaction that turns the contention errors of Datastore into Conflict"""
+        from google.api_core.exceptions import Aborted, Conflict as DatastoreConflict
+        return Transaction(self.client, (Aborted, DatastoreConflict))
+
+    def append(self, record, version):
+        root_key = self.client.key(*self.ROOT)
+
+        with self.transaction():
+            root = self.client.get(root_key)
+            current = root["version"] if root is not None else 0
+
+            if current != version:
+                raise Conflict(current)
+
+            if root is None:
+                root = self.datastore.Entity(key=root_key)
+                root["snapshot"] = 0
+            root["version"] = version + 1
+
+            # I record più grandi del limite di un'entità (es. i salvataggi completi) vengono divisi in più parti,
+            # scritte nella stessa transazione
+            key = self.client.key("Log", version + 1, parent=self.client.key(*self.LOG_ROOT))
+            chunks = [record[index:index + self.PART_BYTES] for index in range(0, len(record), self.PART_BYTES)]
+            entity = self.datastore.Entity(key=key, exclude_from_indexes=("data",))
+            entity["data"] = chunks[0] if chunks else record
+            entity["time"] = time.time()
+            entity["parts"] = max(len(chunks), 1)
+
+            entities = [entity, root]
+            for index, chunk in enumerate(chunks[1:], start=1):
+                part = self.datastore.Entity(key=self.client.key("LogPart", index, parent=key),
+                                             exclude_from_indexes=("data",))
+                part["data"] = chunk
+                entities.append(part)
+            self.client.put_multi(entities)
+
+        return version + 1
+
+    def compact(self, puts, deletes, version):
+        entities = []
+        for kind, name, data in puts:
+            entity = self.datastore.Entity(key=self.key(kind, name), exclude_from_indexes=("data",))
+            entity["data"] = data
+            entities.append(entity)
+
+        keys = [self.key(kind, name) for kind, name in deletes]
+        lock_key = self.client.key(*self.LOCK)
+
+        # Radice e lock occupano due delle modifiche disponibili
+        if (len(entities) + len(keys) <= self.BATCH_SIZE - 2 and
+                sum(len(entity["data"]) for entity in entities) <= self.BATCH_BYTES):
+            with self.transaction():
+                if self.check_lock(self.client.get(lock_key), None):
+                    # Compattazione interrotta: la invalido, così che non possa più scrivere
+                    self.client.delete(lock_key)
+                self.put_snapshot(version)
+                self.client.put_multi(entities)
+                if keys:
+                    self.client.delete_multi(keys)
+            return
+
+        # Troppe modifiche per una sola transazione: prendo il lock e scrivo a blocchi, verificando ogni volta
+        # di possederlo ancora. Le entità scritte prima dello snapshot non sono un problema, perché al
+        # caricamento i record successivi allo snapshot vengono comunque riapplicati sopra di esse.
+        token = uuid.uuid4().hex
+        with self.transaction():
+            self.check_lock(self.client.get(lock_key), None)
+            # Una volta preso il lock nessun altro può spostare lo snapshot, quindi basta verificarlo ora
+            self.check_snapshot(self.client.get(self.client.key(*self.ROOT)), version)
+            lock = self.datastore.Entity(key=lock_key)
+            lock["token"] = token
+            lock["until"] = time.time() + self.LEASE
+            self.client.put(lock)
+
+        limit = self.BATCH_SIZE - 1
+        for batch in self.batches(entities, limit):
+            with self.transaction():
+                self.check_lock(self.client.get(lock_key), token)
+                self.client.put_multi(batch)
+        for index in range(0, len(keys), limit):
+            with self.transaction():
+                self.check_lock(self.client.get(lock_key), token)
+                self.client.delete_multi(keys[index:index + limit])
+
+        with self.transaction():
+            self.check_lock(self.client.get(lock_key), token)
+            self.put_snapshot(version)
+            self.client.delete(lock_key)
+
+    def batches(self, entities, limit):
+        """Splits the entities in batches of at most limit entities and BATCH_BYTES bytes of data"""
+        batch, size = [], 0
+        for entity in entities:
+            if batch and (len(batch) >= limit or size + len(entity["data"]) > self.BATCH_BYTES):
+                yield batch
+                batch, size = [], 0
+            batch.append(entity)
+            size += len(entity["data"])
+
+        if batch:
+            yield batch
+
+    def check_lock(self, lock, token):
+        """
+        Checks the compaction lock.
+        :param lock: The lock entity, or None.
+        :param token: The token of the compaction holding the lock, or None if the lock must be free.
+        :raises: Conflict, if the lock is held by another compaction.
+        :return: True if the lock is left over by an interrupted compaction.
+        """
+        if token is None:
+            if lock is not None and lock["until"] > time.time():
+                raise Conflict("Another instance is compacting")
+            return lock is not None
+        elif lock is None or lock["token"] != token:
+            raise Conflict("Compaction lock lost")
+
+        return False
+
+    def check_snapshot(self, root, version):
+        """Raises Conflict if the root entity has a snapshot newer than the given version"""
+        if root is not None and root["snapshot"] > version:
+            raise Conflict("A newer snapshot already exists")
+
+    def put_snapshot(self, version):
+        """Moves the snapshot of the root entity to the given version. MUST BE called inside a transaction"""
+        root_key = self.client.key(*self.ROOT)
+        root = self.client.get(root_key)
+        self.check_snapshot(root, version)
+
+        if root is None:
+            root = self.datastore.Entity(key=root_key)
+            root["version"] = version
+
+        root["snapshot"] = version
+        self.client.put(root)
+
+    def load_legacy(self):
+        json_data = self.client.get(self.client.key("Data", 1))
+        if json_data is not None:
+            return json_data["groups"], json_data["users"], json_data["drivers"]
+
+        return None
+
+    def is_empty(self):
+        query = self.client.query(ancestor=self.client.key(*self.ROOT))
+        query.keys_only()
+        return next(iter(query.fetch(limit=1)), None) is None and self.client.get(self.client.key("Data", 1)) is None
+
+
+class Transaction:
+    """Datastore transaction raising Conflict instead of the given contention errors"""
+
+    def __init__(self, client, errors):
+        self.transaction = client.transaction()
+        self.errors = errors
+
+    def __enter__(self):
+        return self.transaction.__enter__()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            return self.transaction.__exit__(exc_type, exc_value, traceback)
+        except self.errors as ex:
+            raise Conflict(str(ex))
+
+
+class SqliteStorage(Storage):
+    """Local SQLite backend, in WAL mode so that reads never wait for the flusher"""
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+
+        connection = self.connection()
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("CREATE TABLE IF NOT EXISTS entities ("
+                           "kind TEXT NOT NULL, name TEXT NOT NULL, data BLOB NOT NULL, "
+                           "PRIMARY KEY (kind, name))")
+        connection.execute("CREATE TABLE IF NOT EXISTS log (version INTEGER PRIMARY KEY, data BLOB NOT NULL)")
+        connection.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        connection.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('version', 0)")
+        # Prima del log le entità venivano scritte direttamente, quindi sono aggiornate alla versione corrente
+        connection.execute("INSERT OR IGNORE INTO meta (key, value) "
+                           "SELECT 'snapshot', value FROM meta WHERE key = 'version'")
+
+    def connection(self):
+        """Returns the connection of the current thread, opening it if needed"""
+        connection = getattr(self.local, "connection", None)
+
+        if connection is None:
+            import sqlite3
+            # Le transazioni vengono aperte esplicitamente
+            connection = sqlite3.connect(self.path, isolation_level=None)
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection = connection
+
+        return connection
+
+    def meta(self, connection, key):
+        return connection.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()[0]
+
+    def load(self):
+        connection = self.connection()
+        connection.execute("BEGIN")
+        try:
+            snapshot = self.meta(connection, "snapshot")
+            return (self.meta(connection, "version"), snapshot,
+                    connection.execute("SELECT kind, name, data FROM entities").fetchall(),
+                    self.load_log(snapshot))
+        finally:
+            connection.execute("COMMIT")
+
+    def get_version(self):
+        return self.meta(self.connection(), "version")
+
+    def load_log(self, version):
+        return self.connection().execute("SELECT version, data FROM log WHERE version > ? ORDER BY version",
+                                         (version,)).fetchall()
+
+    def append(self, record, version):
+        connection = self.connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            current = self.meta(connection, "version")
+            if current != version:
+                raise Conflict(current)
+
+            connection.execute("INSERT INTO log (version, data) VALUES (?, ?)", (version + 1, record))
+            connection.execute("UPDATE meta SET value = ? WHERE key = 'version'", (version + 1,))
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+
+        connection.execute("COMMIT")
+        return version + 1
+
+    def compact(self, puts, deletes, version):
+        connection = self.connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            if self.meta(connection, "snapshot") > version:
+                raise Conflict("A newer snapshot already exists")
+
+            connection.executemany("INSERT OR REPLACE INTO entities (kind, name, data) VALUES (?, ?, ?)", puts)
+            connection.executemany("DELETE FROM entities WHERE kind = ? AND name = ?", deletes)
+            connection.execute("UPDATE meta SET value = ? WHERE key = 'snapshot'", (version,))
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+
+        connection.execute("COMMIT")
+
+    def is_empty(self):
+        connection = self.connection()
+        return (connection.execute("SELECT 1 FROM entities LIMIT 1").fetchone() is None and
+                connection.execute("SELECT 1 FROM log LIMIT 1").fetchone() is None)
+
+
+class Backend:
+    instance = None
+
+
+def storage():
+    """Returns the storage backend selected in common.STORAGE, creating it on first use"""
+    if Backend.instance is None:
+        if common.STORAGE == "sqlite":
+            Backend.instance = SqliteStorage(common.SQLITE_PATH)
+        elif common.STORAGE == "datastore":
+            Backend.instance = DatastoreStorage()
+        else:
+            raise ValueError(f"Unknown storage backend: {common.STORAGE}")
+
+        log.info(f"Using {type(Backend.instance).__name__}")
+
+    return Backend.instance
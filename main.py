@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 import logging as log
 
-from flask import Flask, request
+from flask import Flask, jsonify, request
 
 from data.secrets import bot_token
 
@@ -40,36 +40,51 @@ def index():
 @app.route('/' + bot_token, methods=['POST'])
 def update():
     import telegram
-    from data.dumpable import dump_data, empty_dataset, get_data
+    from data.dumpable import dump_data, empty_dataset, refresh_data
     from routing.webhook import process, BotUtils
+    from routing.webhook_reply import Replies, register_reply
+    from util import common
 
     if empty_dataset():
         log.critical("Operating with an empty dataset! Restoring...")
-        get_data()
+
+    # Ricarico i dati solo se un'altra istanza li ha modificati nel frattempo
+    refresh_data()
 
     # Evoco il bot
     # De-Jsonizzo l'update
     t_update = telegram.Update.de_json(request.get_json(force=True), BotUtils.bot)
     # log.info(t_update)
-    # Faccio processare al dispatcher l'update
+    # Faccio processare al dispatcher l'update, attendendo la prima chiamata alla Bot API da restituire come
+    # risposta al webhook
+    reply = register_reply(t_update.update_id) if common.WEBHOOK_REPLY else None
     process(t_update)
-    # Infine salvo eventuali dati modificati; ci provo finché non vengono
-    # lanciate eccezioni
-    # while True:
-    try:
-        dump_data()
-        log.info("Dumping data to database")
-    except Exception as ex:
-        log.critical("Failed to save data!")
+    body = None
+    if reply is not None:
+        body = reply.wait(common.WEBHOOK_REPLY_TIMEOUT)
+        Replies.pending.pop(t_update.update_id, None)
+    # Infine salvo eventuali dati modificati. In modalità write-behind se ne occupa
+    # il flusher in background, senza far attendere il webhook
+    if not common.WRITE_BEHIND:
+        try:
+            dump_data()
+            log.info("Dumping data to database")
+        except Exception as ex:
+            log.critical("Failed to save data!")
+
+    if body is not None:
+        return jsonify(body), 200
 
     return "See console for output", 200
 
 
 @app.route('/data', methods=['GET'])
 def data():
-    from data.dumpable import get_data, print_data
-    get_data()
+    from data.dumpable import refresh_data, print_data
+    from routing.filters import log_timings
+    refresh_data()
     print_data()
+    log_timings()
 
     return "Data output in console.", 200
 
@@ -82,11 +97,13 @@ def script():
 @app.route('/night', methods=['GET'])
 def night():
     if 'X-Appengine-Cron' in request.headers:
-        from data.dumpable import get_data, dump_data
+        from data.dumpable import lock, refresh_data, dump_data
         from services.night import process_day
 
-        get_data()
-        process_day()
+        refresh_data()
+        # Come gli shard, i cron tengono il lock in modo esclusivo tranne durante le chiamate alla Bot API
+        with lock:
+            process_day()
         dump_data()
 
         return "See console for output.", 200
@@ -97,11 +114,12 @@ def night():
 @app.route('/weekly_report', methods=['GET'])
 def weekly():
     if 'X-Appengine-Cron' in request.headers:
-        from data.dumpable import get_data, dump_data
+        from data.dumpable import lock, refresh_data, dump_data
         from services.night import weekly_report
 
-        get_data()
-        weekly_report()
+        refresh_data()
+        with lock:
+            weekly_report()
         dump_data()
 
         return "See console for output.", 200
@@ -112,11 +130,12 @@ def weekly():
 @app.route('/reminders', methods=['GET'])
 def reminders():
     if 'X-Appengine-Cron' in request.headers:
-        from data.dumpable import get_data
+        from data.dumpable import lock, refresh_data
         from services.reminders import remind
 
-        get_data()
-        remind()
+        refresh_data()
+        with lock:
+            remind()
 
         return "See console for output.", 200
     else:
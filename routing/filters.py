@@ -1,10 +1,16 @@
 # -*- coding: utf-8 -*-
 import logging as log
+import threading
+import time
+from functools import wraps
 
 import telegram
 
 from data import secrets
 from data.data_api import all_users
+from data.dumpable import lock
+from routing.sender import submit
+from util import common
 
 
 #
@@ -12,20 +18,165 @@ from data.data_api import all_users
 # con lo slash oppure inline, ovvero callback query, messaggi di cancellazione, errori e messaggi in chat pubbliche.
 #
 
+# Formato compatto delle callback data (al massimo 64 byte per Telegram): dopo il prefisso di versione, i valori
+# sono separati da ; e ciascuno è codificato come
+#  - il codice di una parola nota di CALLBACK_TOKENS (uno o due caratteri alfanumerici)
+#  - # seguito da un numero intero in base 62, per i chat_id e gli altri numeri
+#  - ' seguito dal valore così com'è, per tutto il resto
+# Le callback data senza prefisso sono nel formato precedente, con i valori separati da ; e mai codificati.
+CALLBACK_VERSION = "~1"
+
+# Parole note, dalla più frequente. NON vanno mai rimosse o riordinate, solo aggiunte in fondo, altrimenti
+# i bottoni dei messaggi già inviati cambierebbero significato
+CALLBACK_TOKENS = (
+    "EXIT", "TRIPS", "ME", "EDIT_BOOK", "BOOKING", "ME_MENU", "EDIT_TRIP", "ADD_TRIP", "LIST", "DAY", "START",
+    "EDIT_MONEY", "ADD_PASS", "SELECT", "BOOKING_MENU", "SHOW_BOOKINGS", "MONEY", "EDIT_PASS", "CONFIRM", "ADD",
+    "SUS_TRIP", "SUS_BOOK", "SEND_LOCATION", "NEW_DEBITOR", "MINUTE", "INFO_BOOK", "HOUR", "ED_DR_SL",
+    "EDIT_TRIP_MIN", "EDIT_TRIP_HOUR", "CO_EDIT_TRIP", "ZERO", "VIEW", "US_RE", "SUBTRACT", "REMOVE_TRIP",
+    "REMOVE_PASS", "NEW", "MODE", "DRIVER", "DELETION", "CO_US_RE", "CO_SUS_TRIP", "CO_SUS_BOOK", "CO_RE_TR",
+    "CO_RE_PA", "CO_DR_RE", "CO_DR", "CO_DEL", "CO_BO", "CONFIRM_PARK", "ALERT_USER", "ACTION",
+    "Salita", "Discesa", "Permanent", "Temporary", "SuspendedUsers",
+    "Lunedì", "Martedì", "Mercoledì", "Giovedì", "Venerdì", "Sabato", "Domenica",
+    "Vietnam", "Povo 2 (fronte entrata)", "Povo 1 (parcheggio VIP)", "Povo 1 (cima scale)",
+    "Povo 1 (fronte entrata)", "Povo 0", "Mesiano (fuori)", "Mesiano (fronte entrata)",
+)
+
+BASE62 = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+
+# Codici delle parole note, con un carattere per le prime 62 e due per le successive
+token_codes = dict(zip(CALLBACK_TOKENS, [*BASE62, *(first + second for first in BASE62 for second in BASE62)]))
+code_tokens = {code: token for token, code in token_codes.items()}
+
+
 def create_callback_data(*args):
-    """Crea una stringa a partire dai vlaori (arbitrari) in entrata, che verranno separati da ;"""
-    return ";".join(str(i) for i in args)
+    """Crea una stringa a partire dai valori (arbitrari) in entrata, codificandoli nel formato compatto"""
+    return CALLBACK_VERSION + ";".join(encode_callback_value(str(i)) for i in args)
 
 
 def separate_callback_data(data):
-    """Separa i dati in entrata"""
-    return [i for i in data.split(";")]
+    """Separa i dati in entrata, restituendoli come stringhe. Accetta anche il formato precedente"""
+    if not data.startswith(CALLBACK_VERSION):
+        return data.split(";")
 
+    return [decode_callback_value(value) for value in data[len(CALLBACK_VERSION):].split(";")]
+
+
+def encode_callback_value(value):
+    """Codifica un singolo valore delle callback data"""
+    code = token_codes.get(value)
+    if code is not None:
+        return code
+
+    # Solo i numeri scritti in forma canonica, così da riottenere esattamente la stessa stringa
+    digits = value[1:] if value.startswith("-") else value
+    if digits.isdigit() and digits.isascii() and (digits == "0" or not digits.startswith("0")) \
+            and value != "-0":
+        number = int(digits)
+        encoded = []
+        while True:
+            number, digit = divmod(number, 62)
+            encoded.append(BASE62[digit])
+            if not number:
+                break
+        return "#" + ("-" if value.startswith("-") else "") + "".join(reversed(encoded))
+
+    return "'" + value
+
+
+def decode_callback_value(value):
+    """Decodifica un singolo valore delle callback data"""
+    if value.startswith("#"):
+        negative = value.startswith("#-")
+        number = 0
+        for digit in value[2 if negative else 1:]:
+            number = number * 62 + BASE62.index(digit)
+        return f"{'-' if negative else ''}{number}"
+    elif value.startswith("'"):
+        return value[1:]
+    else:
+        return code_tokens[value]
+
+
+class Timings:
+    """Time spent in each handler, by name, as [calls, total seconds, maximum seconds]. See record_timing"""
+    handlers = {}
+    lock = threading.Lock()
+
+
+def record_timing(name, elapsed):
+    """Adds the duration in seconds of a run of a handler to its timings"""
+    log.debug(f"Handler {name} took {elapsed * 1000:.1f} ms")
+    with Timings.lock:
+        timing = Timings.handlers.setdefault(name, [0, 0.0, 0.0])
+        timing[0] += 1
+        timing[1] += elapsed
+        timing[2] = max(timing[2], elapsed)
 
-def callback_query_handler(bot, update):
-    from commands import actions_booking, actions_me, actions_money, actions_trips, actions_parking, \
-        actions_show_bookings
 
+def log_timings():
+    """Logs the number of runs, the average and the maximum duration of each handler"""
+    with Timings.lock:
+        for name, (calls, total, maximum) in sorted(Timings.handlers.items()):
+            log.info(f"{name}: {calls} calls, {total / calls * 1000:.1f} ms average, {maximum * 1000:.1f} ms max")
+
+
+class Callbacks:
+    """Handlers of the callback queries, by identifier, as (handler, mutates) tuples. See register_callback"""
+    handlers = {}
+
+
+def register_callback(identifier, handler, mutates=True):
+    """
+    Registers the handler of the callback queries with a given identifier.
+    :param identifier: The first element of the callback data.
+    :param handler: A function taking bot and update.
+    :param mutates: False if the handler only reads the dataset, so that it runs in parallel (see read_only).
+    """
+    Callbacks.handlers[identifier] = (handler if mutates else read_only(handler), mutates)
+
+
+def read_only(handler):
+    """
+    Decorator for the handlers that only read the dataset. They are run on the worker pool of the dispatcher
+    while holding the dataset lock in shared mode, so that they run in parallel with each other but never
+    while the dataset is being modified. Every other handler runs in the shard of its user (see routing.webhook),
+    holding the lock exclusively.
+    """
+    @wraps(handler)
+    def wrapper(bot, update, *args, **kwargs):
+        from routing.webhook import BotUtils
+        from routing.webhook_reply import current_reply
+
+        # La risposta al webhook dell'update passa al worker, che la rilascia al termine
+        reply = current_reply()
+        if reply is not None:
+            reply.start()
+        BotUtils.dispatcher.run_async(run_reading, reply, handler, bot, update, *args, **kwargs)
+
+    return wrapper
+
+
+def run_reading(reply, handler, bot, update, *args, **kwargs):
+    """Runs a handler holding the dataset lock in shared mode, passing Telegram errors to error_handler"""
+    from routing.webhook import BotUtils
+    from routing.webhook_reply import set_current_reply
+
+    set_current_reply(reply)
+    try:
+        with lock.reading():
+            start = time.perf_counter()
+            try:
+                handler(bot, update, *args, **kwargs)
+            except telegram.TelegramError as ex:
+                BotUtils.dispatcher.dispatch_error(update, ex)
+            record_timing(handler.__name__, time.perf_counter() - start)
+    finally:
+        set_current_reply(None)
+        if reply is not None:
+            reply.finish()
+
+
+def callback_query_handler(bot, update):
     chat_id = str(update.callback_query.from_user.id)
 
     if chat_id not in all_users():
@@ -34,56 +185,30 @@ def callback_query_handler(bot, update):
                          text="Attenzione! Stai cercando di effettuare un operazione riservata"
                               " agli utenti registrati. Per favore, registrati con /registra.")
     else:
-        # Mando un azione di "Sto scrivendo..."
-        bot.send_chat_action(chat_id=chat_id, action=telegram.ChatAction.TYPING)
+        # Mando un azione di "Sto scrivendo..." in background, solo se l'handler non termina prima di
+        # CHAT_ACTION_DELAY secondi
+        typing = submit(bot.send_chat_action, chat_id=chat_id, action=telegram.ChatAction.TYPING,
+                        delay=common.CHAT_ACTION_DELAY)
 
         # Nelle callback query, il primo elemento è sempre l'identificatore
         identifier = separate_callback_data(update.callback_query.data)[0]
 
-        # Caso base usato da molti comandi
-        if identifier == "EXIT":
-            cancel_handler(bot, update)
-        # Azione alternativa per /me
-        elif identifier == "ME_MENU":
-            actions_me.me(bot, update)
-        # Azione alternativa per /prenota
-        elif identifier == "BOOKING_MENU":
-            actions_booking.prenota(bot, update)
-        # Azioni in partenza da /prenota
-        elif identifier == "BOOKING":
-            actions_booking.booking_handler(bot, update)
-        elif identifier == "EDIT_BOOK":
-            actions_booking.edit_booking(bot, update)
-        elif identifier == "INFO_BOOK":
-            actions_booking.info_booking(bot, update)
-        elif identifier == "ALERT_USER":
-            actions_booking.alert_user(bot, update)
-        # Azione in partenxza da /parcheggio
-        elif identifier == "CONFIRM_PARK":
-            actions_parking.confirm_parking(bot, update)
-        elif identifier == "SEND_LOCATION":
-            actions_parking.send_location(bot, update)
-        # Azione in partenza da /prenota e da /settimana /lunedi etc
-        elif identifier == "SHOW_BOOKINGS":
-            actions_show_bookings.show_bookings(bot, update)
-        # Azioni in partenza da /me -> trips
-        elif identifier == "TRIPS":
-            actions_trips.trips_handler(bot, update)
-        elif identifier == "ADD_PASS":
-            actions_trips.add_passenger(bot, update)
-        elif identifier == "ADD_TRIP":
-            actions_trips.add_trip(bot, update)
-        # Azioni in partenza da /me
-        elif identifier == "ME":
-            actions_me.me_handler(bot, update)
-        elif identifier == "MONEY":
-            actions_money.check_money(bot, update)
-        elif identifier == "EDIT_MONEY":
-            actions_money.edit_money(bot, update)
-        elif identifier == "NEW_DEBITOR":
-            actions_money.new_debitor(bot, update)
-
-    # Rimuovo il messaggio di caricamento
+        entry = Callbacks.handlers.get(identifier)
+        if entry is not None:
+            handler, mutates = entry
+            start = time.perf_counter()
+            try:
+                handler(bot, update)
+            finally:
+                typing.cancel()
+            # Gli handler in sola lettura vengono misurati nel worker, vedi run_reading
+            if mutates:
+                record_timing(identifier, time.perf_counter() - start)
+        else:
+            typing.cancel()
+            log.warning(f"Unknown callback query: {update.callback_query.data}")
+
+    # Rimuovo il messaggio di caricamento, senza attendere la risposta (vedi webhook_reply.BACKGROUND_METHODS)
     bot.answer_callback_query(callback_query_id=update.callback_query.id)
 
 
@@ -94,17 +219,19 @@ def cancel_handler(bot, update):
                           reply_markup=None)
 
 
-# Questa classe e questo metodo vengono usate nel caso risposte testuali da parte dell'utente.
+# Questa classe e questo metodo vengono usate nel caso risposte testuali da parte dell'utente. La modalità di
+# risposta è tenuta per ogni chat_id, dato che gli update di utenti diversi vengono elaborati in parallelo
 class ReplyStatus:
-    response_mode = 0
+    response_mode = {}
 
 
 def text_filter(bot, update):
     """Per aggiungere un nuovo metodo di risposta testuale, mettere qui l'eventuale redirect"""
-    if ReplyStatus.response_mode == 0:
+    response_mode = ReplyStatus.response_mode.get(update.message.chat_id, 0)
+    if response_mode == 0:
         bot.send_message(chat_id=update.message.chat_id,
                          text="Digita /help per avere informazioni sui comandi.")
-    elif ReplyStatus.response_mode == 1:
+    elif response_mode == 1:
         from commands import actions
         actions.response_registra(bot, update)
 
@@ -1,44 +1,84 @@
 # -*- coding: utf-8 -*-
 from telegram import InlineQueryResultArticle, InputTextMessageContent
 
-from data.data_api import all_users, get_trip_group, get_name, get_trip
+from data.data_api import all_users, get_name, get_names, get_trip, search_trips, data_version
 from util import common
 
 
+class Results:
+    """Inline results of the last queries, valid until the dataset changes"""
+    cache = {}
+    version = None  # Valore di data_version() per cui i risultati sono validi
+
+
 def inline_handler(bot, update):
-    query = update.inline_query.query.lower()
+    query = " ".join(update.inline_query.query.lower().split())
     chat_id = str(update.inline_query.from_user.id)
     if not query or chat_id not in all_users():
         return
 
+    try:
+        offset = int(update.inline_query.offset or 0)
+    except ValueError:
+        offset = 0
+
+    results = get_results(query)
+    end = offset + common.INLINE_PAGE_SIZE
+
+    # I risultati sono riservati agli utenti registrati, quindi Telegram non deve condividerli tra utenti
+    bot.answer_inline_query(update.inline_query.id, results[offset:end],
+                            cache_time=common.INLINE_CACHE_TIME,
+                            is_personal=True,
+                            next_offset=str(end) if end < len(results) else "")
+
+
+def get_results(query):
+    """
+    Returns the inline results of a query, building them only if the dataset has changed since the last time.
+    :param query: The normalized query.
+    :return: A list of InlineQueryResultArticle.
+    """
+    version = data_version()
+    if Results.version != version:
+        Results.cache = {}
+        Results.version = version
+
+    results = Results.cache.get(query)
+    if results is None:
+        if len(Results.cache) >= common.INLINE_CACHE_SIZE:
+            Results.cache = {}
+
+        results = Results.cache[query] = build_results(query)
+
+    return results
+
+
+def build_results(query):
     results = []
 
-    for day in common.work_days:
-        for direction in "Salita", "Discesa":
-            for driver in get_trip_group(direction, day):
-                driver_name = get_name(driver)
-                if query in day.lower() or query in driver_name.lower():
-                    # Visualizzo solo le query contenenti giorno o autista
-                    trip = get_trip(direction, day, driver)
-                    people = ', '.join([f"{get_name(user)}" for mode in trip
-                                        if mode == "Temporary" or mode == "Permanent" for user in trip[mode]])
-                    results.append(
-                        InlineQueryResultArticle(
-                            id=f"{direction}{day}{driver}",
-                            title=f"{driver_name.split(' ')[-1]} {day} {common.dir_name(direction)}",
-                            input_message_content=InputTextMessageContent(
-                                f"\n\n🚗 {driver_name}"
-                                f"{' - 🚫 Sospeso' if trip['Suspended'] else ''}"
-                                f"\n🗓 {day}"
-                                f"\n🕓 {trip['Time']}"
-                                f"\n{common.dir_name(direction)}"
-                                f"\n👥 {people}"
-                            ),
-                            hide_url=True,
-                            thumb_url=common.povo_url if direction == "Salita" else common.nest_url,
-                            thumb_height=40,
-                            thumb_width=40
-                        )
-                    )
-
-    bot.answer_inline_query(update.inline_query.id, results)
+    # Visualizzo solo i viaggi il cui giorno o autista corrispondono alla query
+    for direction, day, driver in search_trips(query):
+        driver_name = get_name(driver)
+        trip = get_trip(direction, day, driver)
+        people = ', '.join(get_names(user for user_group in (trip.permanent, trip.temporary)
+                                     for user in user_group))
+        results.append(
+            InlineQueryResultArticle(
+                id=f"{direction}{day}{driver}",
+                title=f"{driver_name.split(' ')[-1]} {day} {common.dir_name(direction)}",
+                input_message_content=InputTextMessageContent(
+                    f"\n\n🚗 {driver_name}"
+                    f"{' - 🚫 Sospeso' if trip.suspended else ''}"
+                    f"\n🗓 {day}"
+                    f"\n🕓 {trip.time}"
+                    f"\n{common.dir_name(direction)}"
+                    f"\n👥 {people}"
+                ),
+                hide_url=True,
+                thumb_url=common.povo_url if direction == "Salita" else common.nest_url,
+                thumb_height=40,
+                thumb_width=40
+            )
+        )
+
+    return results
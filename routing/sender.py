@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+import heapq
+import itertools
+import logging as log
+import threading
+import time
+
+from util import common
+
+#
+# Thread che inviano in background le chiamate alla Bot API di cui non serve attendere il risultato, come
+# answer_callback_query e send_chat_action, così che non rallentino l'elaborazione degli update. Le chiamate
+# possono essere ritardate e annullate prima dell'invio. Con più thread (common.SENDERS) le chiamate vengono
+# avviate in ordine ma possono terminare in ordine diverso, cosa che per queste chiamate non cambia nulla.
+#
+
+
+class Sender:
+    """Background threads sending Bot API calls, with the calls still to send as a heap of (due, order, task)"""
+    threads = []
+    condition = threading.Condition()
+    tasks = []
+    order = itertools.count()
+
+
+class Task:
+    __slots__ = ("function", "args", "kwargs", "cancelled")
+
+    def __init__(self, function, args, kwargs):
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.cancelled = False
+
+    def cancel(self):
+        """Cancels the call, if it has not been sent yet"""
+        self.cancelled = True
+
+
+def submit(function, *args, delay=0, **kwargs):
+    """
+    Schedules a call on the sender threads. Calls with the same due time are started in order.
+    :param function: The function to call, usually a method of the bot.
+    :param delay: Number of seconds to wait before the call.
+    :return: The Task of the call, that can be cancelled.
+    """
+    task = Task(function, args, kwargs)
+    with Sender.condition:
+        if not Sender.threads:
+            Sender.threads = [threading.Thread(target=send_loop, name=f"sender_{i}", daemon=True)
+                              for i in range(common.SENDERS)]
+            for thread in Sender.threads:
+                thread.start()
+
+        heapq.heappush(Sender.tasks, (time.monotonic() + delay, next(Sender.order), task))
+        Sender.condition.notify()
+    return task
+
+
+def is_sender_thread():
+    return threading.current_thread() in Sender.threads
+
+
+def send_loop():
+    """Body of the sender threads: waits for the first call to be due, then sends it"""
+    while True:
+        with Sender.condition:
+            while not Sender.tasks or Sender.tasks[0][0] > time.monotonic():
+                Sender.condition.wait(Sender.tasks[0][0] - time.monotonic() if Sender.tasks else None)
+            _, _, task = heapq.heappop(Sender.tasks)
+
+        if task.cancelled:
+            continue
+
+        try:
+            task.function(*task.args, **task.kwargs)
+        except Exception as ex:
+            log.error(f"Failed to send {getattr(task.function, '__name__', task.function)}: {ex!r}")
@@ -4,31 +4,64 @@ import time
 from queue import Queue
 from threading import Thread
 
-from telegram import Bot
-from telegram.ext import Dispatcher, CommandHandler, MessageHandler, CallbackQueryHandler, Filters, InlineQueryHandler
+from telegram import Bot, Update
+from telegram.ext import Dispatcher, CommandHandler, MessageHandler, CallbackQueryHandler, Filters, \
+    InlineQueryHandler, TypeHandler
 
 from data import secrets
 from routing import inline, filters
-from routing.filters import error_handler
+from routing.filters import error_handler, read_only, register_callback
+from routing.webhook_reply import ReplyRequest, begin_reply, end_reply
 from util import common
 
 
+def shard_loop(queue):
+    """
+    Body of the shard threads: handles the updates of a queue one at a time, holding the dataset lock
+    exclusively except while waiting for the Bot API (see data.dumpable.unlocked).
+    """
+    from data.dumpable import lock, dump_data
+
+    while True:
+        update = queue.get()
+        with lock:
+            BotUtils.dispatcher.process_update(update)
+
+        # Senza write-behind salvo subito le modifiche, dato che l'update viene elaborato dopo la risposta al
+        # webhook. Il salvataggio avviene dopo aver rilasciato il lock, così che non blocchi gli altri shard
+        if not common.WRITE_BEHIND:
+            try:
+                dump_data()
+            except Exception as ex:
+                log.critical("Failed to save data!")
+                log.critical(ex)
+
+
 class BotUtils:
-    bot = Bot(secrets.bot_token)
+    # Una connessione per ogni thread che può usare il bot (shard, worker e sender), più qualcuna di scorta
+    bot = Bot(secrets.bot_token,
+              request=ReplyRequest(con_pool_size=common.SHARDS + common.WORKERS + common.SENDERS + 4))
+    # Il dispatcher tiene gli handler e i worker degli handler in sola lettura, ma gli update vengono elaborati
+    # dagli shard (vedi process), quindi la sua coda resta vuota
     update_queue = Queue()
-    dispatcher = Dispatcher(bot, update_queue)
+    dispatcher = Dispatcher(bot, update_queue, workers=common.WORKERS)
     thread = Thread(target=dispatcher.start, name='dispatcher')
+    # Una coda e un thread per ogni shard
+    shard_queues = [Queue() for _ in range(common.SHARDS)]
+    shards = [Thread(target=shard_loop, args=(queue,), name=f'shard_{i}', daemon=True)
+              for i, queue in enumerate(shard_queues)]
 
     def __init__(self):
         log.info("BotUtils instance up and running.")
 
     @staticmethod
     def start_thread():
-        try:
-            BotUtils.thread.start()
-        except RuntimeError as ex:
-            log.critical(ex)
-            log.critical("Tried to start an active Thread!")
+        for thread in [BotUtils.thread, *BotUtils.shards]:
+            try:
+                thread.start()
+            except RuntimeError as ex:
+                log.critical(ex)
+                log.critical("Tried to start an active Thread!")
 
     @staticmethod
     def set_webhook():
@@ -37,30 +70,39 @@ class BotUtils:
 
 def dispatcher_setup():
     from commands import actions, actions_booking, actions_me, actions_parking
-    from data.dumpable import get_data, dump_data
+    from data.dumpable import get_data, dump_data, start_flusher
 
-    # Inizio prendendo i dati da Datastore
+    # Inizio prendendo i dati dal backend di salvataggio
     outcome = get_data()
-    log.info("Getting data from Cloud Datastore...")
+    log.info("Getting data from storage...")
 
     # Se non ci sono dati, provo a inviarli da quanto salvato in secrets.py
     if not outcome:
-        outcome = dump_data()
-        log.info("Dumping data to Cloud Datastore...")
+        outcome = dump_data(full=True)
+        log.info("Dumping data to storage...")
 
     # Se non ci sono manco quelli, non ha senso far partire il bot
     if not outcome:
         log.info("Failed to start bot!")
         raise SystemExit
 
+    # Avvio il salvataggio in background dei dati
+    if common.WRITE_BEHIND:
+        start_flusher()
+
     # Inizializzo il dispatcher
     BotUtils.start_thread()
     dispatcher = BotUtils.dispatcher
 
     # Filtri per tutto il resto
     dispatcher.add_error_handler(error_handler)
+    # Tutti gli handler sono nel gruppo 0: questi due vengono eseguiti prima e dopo di loro per ogni update,
+    # per associare al dispatcher l'eventuale risposta al webhook (vedi webhook_reply)
+    dispatcher.add_handler(TypeHandler(Update, begin_reply), group=-1)
+    dispatcher.add_handler(TypeHandler(Update, end_reply), group=1)
     dispatcher.add_handler(CallbackQueryHandler(filters.callback_query_handler))
-    dispatcher.add_handler(InlineQueryHandler(inline.inline_handler))
+    register_callbacks()
+    dispatcher.add_handler(InlineQueryHandler(read_only(inline.inline_handler)))
 
     dispatcher.add_handler(MessageHandler(~ Filters.private, filters.public_filter))
     dispatcher.add_handler(MessageHandler(Filters.text & Filters.private, filters.text_filter))
@@ -76,23 +118,30 @@ def dispatcher_setup():
 
     # Azioni in partenza da actions.py
     dispatcher.add_handler(CommandHandler("start", actions.start))
-    dispatcher.add_handler(CommandHandler("help", actions.help))
-    dispatcher.add_handler(CommandHandler("oggi", actions.oggi))
-    dispatcher.add_handler(CommandHandler("domani", actions.domani))
+    dispatcher.add_handler(CommandHandler("help", read_only(actions.help)))
+    dispatcher.add_handler(CommandHandler("oggi", read_only(actions.oggi)))
+    dispatcher.add_handler(CommandHandler("domani", read_only(actions.domani)))
     dispatcher.add_handler(CommandHandler("registra", actions.registra))
     dispatcher.add_handler(CommandHandler("ban", actions.ban_user, pass_args=True))
 
     # Azioni dei giorni singoli in partenza da actions.py
-    dispatcher.add_handler(CommandHandler("lunedi", actions.lunedi))
-    dispatcher.add_handler(CommandHandler("martedi", actions.martedi))
-    dispatcher.add_handler(CommandHandler("mercoledi", actions.mercoledi))
-    dispatcher.add_handler(CommandHandler("giovedi", actions.giovedi))
-    dispatcher.add_handler(CommandHandler("venerdi", actions.venerdi))
+    dispatcher.add_handler(CommandHandler("lunedi", read_only(actions.lunedi)))
+    dispatcher.add_handler(CommandHandler("martedi", read_only(actions.martedi)))
+    dispatcher.add_handler(CommandHandler("mercoledi", read_only(actions.mercoledi)))
+    dispatcher.add_handler(CommandHandler("giovedi", read_only(actions.giovedi)))
+    dispatcher.add_handler(CommandHandler("venerdi", read_only(actions.venerdi)))
+
+
+def shard_of(update):
+    """Returns the shard of an update: all the updates of a user go to the same shard, so they stay in order"""
+    owner = update.effective_user or update.effective_chat
+    key = owner.id if owner is not None else update.update_id
+    return hash(key) % common.SHARDS
 
 
 def process(update, counter=0):
     try:
-        BotUtils.update_queue.put(update)
+        BotUtils.shard_queues[shard_of(update)].put(update)
     except NameError as ex:
         dispatcher_setup()
         if counter < common.MAX_ATTEMPTS:
@@ -101,3 +150,35 @@ def process(update, counter=0):
         else:
             log.critical("Failed to initialize Dispatcher instance")
             log.critical(ex)
+
+
+def register_callbacks():
+    """Registers the handler of each callback query identifier, flagging the ones that only read the dataset"""
+    from commands import actions_booking, actions_me, actions_money, actions_parking, actions_trips, \
+        actions_show_bookings
+
+    # Caso base usato da molti comandi
+    register_callback("EXIT", filters.cancel_handler, mutates=False)
+    # Azione alternativa per /me
+    register_callback("ME_MENU", actions_me.me, mutates=False)
+    # Azione alternativa per /prenota
+    register_callback("BOOKING_MENU", actions_booking.prenota, mutates=False)
+    # Azioni in partenza da /prenota
+    register_callback("BOOKING", actions_booking.booking_handler)
+    register_callback("EDIT_BOOK", actions_booking.edit_booking)
+    register_callback("INFO_BOOK", actions_booking.info_booking, mutates=False)
+    register_callback("ALERT_USER", actions_booking.alert_user)
+    # Azioni in partenza da /parcheggio
+    register_callback("CONFIRM_PARK", actions_parking.confirm_parking)
+    register_callback("SEND_LOCATION", actions_parking.send_location, mutates=False)
+    # Azione in partenza da /prenota e da /settimana /lunedi etc
+    register_callback("SHOW_BOOKINGS", actions_show_bookings.show_bookings, mutates=False)
+    # Azioni in partenza da /me -> trips
+    register_callback("TRIPS", actions_trips.trips_handler)
+    register_callback("ADD_PASS", actions_trips.add_passenger)
+    register_callback("ADD_TRIP", actions_trips.add_trip)
+    # Azioni in partenza da /me
+    register_callback("ME", actions_me.me_handler)
+    register_callback("MONEY", actions_money.check_money, mutates=False)
+    register_callback("EDIT_MONEY", actions_money.edit_money)
+    register_callback("NEW_DEBITOR", actions_money.new_debitor)
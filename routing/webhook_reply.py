@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+import json
+import logging as log
+import threading
+
+from telegram.utils.request import Request
+
+from data.dumpable import unlocked
+from routing.sender import is_sender_thread, submit
+
+#
+# Telegram permette di rispondere a un webhook con una chiamata della Bot API, risparmiando una richiesta HTTPS.
+# Quando WEBHOOK_REPLY è attivo, la prima chiamata idonea fatta durante l'elaborazione di un update non viene
+# inviata ma restituita come risposta al webhook (vedi main.update). Il risultato di queste chiamate non è
+# disponibile: i metodi del bot ritornano True e Telegram non segnala in alcun modo gli errori, quindi un
+# messaggio rifiutato (es. Markdown non valido) va perso senza lasciare traccia. Per questo WEBHOOK_REPLY è
+# disattivato di default. Le risposte che non possono essere costruite vengono registrate nel log e inviate
+# normalmente.
+#
+
+# Chiamate che possono essere restituite al webhook
+REPLY_METHODS = {"sendMessage", "editMessageText", "editMessageReplyMarkup", "sendLocation",
+                 "answerCallbackQuery", "answerInlineQuery"}
+
+# Chiamate che non producono messaggi, e che quindi possono essere inviate prima di quella trattenuta senza
+# cambiare l'ordine dei messaggi visti dall'utente
+UNORDERED_METHODS = {"answerCallbackQuery", "answerInlineQuery", "sendChatAction"}
+
+# Chiamate non trattenute che vengono inviate in background dal sender, senza attenderne la risposta
+BACKGROUND_METHODS = {"answerCallbackQuery", "sendChatAction"}
+
+
+class Replies:
+    """Webhook replies waiting for their update, by update_id, and the reply of the update handled by each thread"""
+    pending = {}
+    current = threading.local()
+
+
+class WebhookReply:
+    def __init__(self):
+        self.condition = threading.Condition()
+        # Chiamata trattenuta, come tupla (url, data), e Request con cui inviarla se non può essere restituita
+        self.call = None
+        self.request = None
+        # Elaborazioni ancora in corso: quella del dispatcher più gli handler in sola lettura avviati
+        self.running = 1
+        self.closed = False
+
+    def claim(self, url, data, request):
+        """
+        Tries to take a Bot API call as the reply to the webhook.
+        :param url: The url of the call.
+        :param data: The parameters of the call.
+        :param request: The Request making the call, used to send it if the reply cannot be built.
+        :return: A (claimed, flushed) tuple: claimed is True if the call was taken, flushed is the call taken
+            before, if any, that has to be sent right away to keep the messages in order.
+        """
+        method = url.rsplit("/", 1)[-1]
+        with self.condition:
+            if self.closed:
+                return False, None
+            if self.call is None:
+                if method not in REPLY_METHODS:
+                    return False, None
+                self.call, self.request = (url, data), request
+                return True, None
+            if method not in UNORDERED_METHODS and self.call[0].rsplit("/", 1)[-1] not in UNORDERED_METHODS:
+                flushed, self.call, self.closed = self.call, None, True
+                # Non c'è più niente da restituire: il webhook può rispondere senza attendere la fine dell'update
+                self.condition.notify_all()
+                return False, flushed
+            return False, None
+
+    def start(self):
+        """Signals that a handler of the update has been started on another thread"""
+        with self.condition:
+            self.running += 1
+
+    def finish(self):
+        """Signals that the dispatcher, or a handler started with start, is done with the update"""
+        with self.condition:
+            self.running -= 1
+            self.condition.notify_all()
+
+    def wait(self, timeout):
+        """
+        Waits for the update to be handled, or for the reply to be given up, then closes the reply.
+        :param timeout: The maximum number of seconds to wait.
+        :return: The body of the webhook reply as a dictionary, or None if no call was taken.
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: self.running <= 0 or (self.closed and self.call is None), timeout)
+            self.closed = True
+            call, self.call = self.call, None
+
+        if call is None:
+            return None
+
+        url, data = call
+        body = {"method": url.rsplit("/", 1)[-1]}
+        try:
+            for key, value in data.items():
+                # I bot serializzano già la reply_markup come stringa JSON
+                body[key] = json.loads(value) if key == "reply_markup" and isinstance(value, str) else value
+            json.dumps(body)
+        except (TypeError, ValueError) as ex:
+            # Ad esempio file da caricare: la chiamata viene inviata come se non fosse stata trattenuta
+            log.error(f"Cannot reply to the webhook with {body['method']}, sending it instead: {ex!r}")
+            try:
+                self.request.post(url, data)
+            except Exception as ex:
+                log.error(f"Failed to send {body['method']}: {ex!r}")
+            return None
+
+        return body
+
+
+class ReplyRequest(Request):
+    """
+    Request that lets the webhook reply take the calls of the update being handled, and that sends the calls in
+    BACKGROUND_METHODS on the sender thread. The dataset lock is released while waiting for Telegram
+    """
+
+    def post(self, url, data, timeout=None):
+        reply = current_reply()
+        if reply is not None:
+            claimed, flushed = reply.claim(url, data, self)
+            if claimed:
+                return True
+            if flushed is not None:
+                with unlocked():
+                    super().post(*flushed)
+
+        if url.rsplit("/", 1)[-1] in BACKGROUND_METHODS and not is_sender_thread():
+            submit(super().post, url, data, timeout=timeout)
+            return True
+
+        with unlocked():
+            return super().post(url, data, timeout=timeout)
+
+
+def register_reply(update_id):
+    """Creates the webhook reply of an update, before it is passed to the dispatcher"""
+    reply = WebhookReply()
+    Replies.pending[update_id] = reply
+    return reply
+
+
+def current_reply():
+    """Returns the webhook reply of the update handled by the current thread, or None"""
+    return getattr(Replies.current, "reply", None)
+
+
+def set_current_reply(reply):
+    Replies.current.reply = reply
+
+
+def begin_reply(bot, update):
+    """Handler run before all the others: binds the webhook reply of the update, if any, to the dispatcher"""
+    set_current_reply(Replies.pending.pop(update.update_id, None))
+
+
+def end_reply(bot, update):
+    """Handler run after all the others: releases the webhook reply of the update"""
+    reply = current_reply()
+    set_current_reply(None)
+    if reply is not None:
+        reply.finish()
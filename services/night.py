@@ -3,8 +3,8 @@
 import datetime
 import logging as log
 
-from data.data_api import get_trip_group, get_name, is_driver, all_users, get_slots, remove_single_debit, \
-    get_debit_tuple, get_credits, quick_debit_edit
+from data.data_api import get_trip_group, get_name, is_driver, is_registered, all_users, get_debit_tuple, \
+    get_credits, charge_trip, restore_suspended_booking, remove_trip, unsuspend_trip, clear_temporary, remove_location
 from routing.webhook import BotUtils
 from util import common
 
@@ -51,9 +51,10 @@ def process_direction(direction):
 
 def process_driver(direction, driver, trip):
     today = datetime.datetime.today()
+    day = common.day_to_string(today.weekday() - 1)
 
     # Caso in cui il viaggio è sospeso
-    if trip[driver]["Suspended"]:
+    if trip[driver].suspended:
         try:
             process_suspended_trip(direction, driver, trip)
         except Exception as ex:
@@ -70,7 +71,7 @@ def process_driver(direction, driver, trip):
 
     if common.is_sessione():
         try:
-            del trip[driver]
+            remove_trip(direction, day, driver)
         except Exception as ex:
             log.critical(ex)
             messages.append(f"⚠ Exception in trip removal: {direction}/{driver}")
@@ -82,13 +83,9 @@ def process_money(direction, driver, trip):
 
     # Prima addebito tutti gli utenti
     for mode in "Temporary", "Permanent":
-        for user in trip[driver][mode]:
+        for user in list(trip[driver].passengers(mode)):
             try:
-                new_debit = quick_debit_edit(user, driver, "+")
-
-                if new_debit == 0:
-                    remove_single_debit(user, driver)
-
+                charge_trip(user, driver)
                 messages.append(f"Added debit to u{user} from d{driver} {direction} ")
             except Exception as ex:
                 log.critical(ex)
@@ -102,14 +99,28 @@ def process_money(direction, driver, trip):
                              text=f"{str(get_name(user))} ha un nuovo viaggio da pagarti.")
             messages.append(f"Alerted user for debit: u{user} d{driver} {direction}")
 
-    # Poi ripristino le persone sospese
-    for user in trip[driver]["SuspendedUsers"]:
-        occupied_slots = len(trip[driver]["Permanent"]) + len(trip[driver]["Temporary"])
-        total_slots = get_slots(driver)
+    # Elimino eventuali persone temporanee, prima di ripristinare le persone sospese così che i loro posti
+    # siano di nuovo liberi
+    try:
+        clear_temporary(direction, day, driver)
+        messages.append(f"Emptied temporary users: {driver} {direction}")
+    except Exception as ex:
+        log.critical(ex)
+        messages.append(f"⚠ Failed to empty temporary users {driver} {direction}")
+
+    # Poi ripristino le persone sospese. Il controllo dei posti e lo spostamento avvengono insieme in
+    # restore_suspended_booking, così da essere ripetuti anche in caso di conflitto con un'altra istanza
+    for user in list(trip[driver].suspended_users):
+        try:
+            restored = restore_suspended_booking(direction, day, driver, user) is not None
+        except Exception as ex:
+            log.critical(ex)
+            messages.append(f"⚠ Error in restoring booking for: u{user} d{driver} {direction}")
+            continue
 
         # Può capitare che altre persone occupino il posto alle persone sospese.
         # Bisogna gestire questo caso avvisando l'autista e il passeggero.
-        if occupied_slots > total_slots:
+        if not restored:
             bot.send_message(chat_id=str(user),
                              text=f"ATTENZIONE: Non è stato possibile ripristinare"
                              f" la tua prenotazione di {day.lower()} con "
@@ -118,15 +129,9 @@ def process_money(direction, driver, trip):
                              f"; qualcun'altro ha occupato il tuo posto. "
                              f"Contatta l'autista per risolvere il problema.")
             messages.append(f"Overbooking for: u{user} d{driver}  {direction}")
-        # Caso normale, la persona è spostata su Permanent
+        # Caso normale, la persona è stata spostata su Permanent
         else:
-            try:
-                trip[driver]["Permanent"].append(user)
-                trip[driver]["SuspendedUsers"].remove(user)
-                messages.append(f"Booking restored: u{user} d{driver} {direction}")
-            except Exception as ex:
-                log.critical(ex)
-                messages.append(f"⚠ Error in restoring booking for: u{user} d{driver} {direction}")
+            messages.append(f"Booking restored: u{user} d{driver} {direction}")
 
             bot.send_message(chat_id=str(user),
                              text=f"La prenotazione per {day.lower()} con "
@@ -140,37 +145,28 @@ def process_money(direction, driver, trip):
                              f"{common.dir_name(direction)} è stata ripristinata.")
             messages.append(f"Alerted driver for booking restored: u{user} d{driver} {direction}")
 
-    # Elimino eventuali persone temporanee
-    try:
-        trip[driver]["Temporary"] = []
-        messages.append(f"Emptied temporary users: {driver} {direction}")
-    except Exception as ex:
-        log.critical(ex)
-        messages.append(f"⚠ Failed to empty temporary users {driver} {direction}")
-
     # Cancello l'eventuale ritrovo del giorno
-    try:
-        del trip[driver]["Location"]
-        messages.append(f"Removed location: {driver} {direction}")
-    except KeyError:
-        pass
-    except Exception as ex:
-        log.critical(ex)
-        messages.append(f"⚠ Failed to remove location {driver} {direction}")
+    if trip[driver].location is not None:
+        try:
+            remove_location(direction, day, driver)
+            messages.append(f"Removed location: {driver} {direction}")
+        except Exception as ex:
+            log.critical(ex)
+            messages.append(f"⚠ Failed to remove location {driver} {direction}")
 
 
 def process_suspended_trip(direction, driver, trip):
     today = datetime.datetime.today()
     day = common.day_to_string(today.weekday() - 1)
 
-    trip[driver]["Suspended"] = False  # Rimuovo la sospensione del viaggio
+    unsuspend_trip(direction, day, driver)  # Rimuovo la sospensione del viaggio
     bot.send_message(chat_id=driver,
                      text=f"Il tuo viaggio di {day.lower()} "
                      f"{common.dir_name(direction)} è stato ripristinato.")
     messages.append(f"Restored trip: {direction} {driver}")
 
     for mode in "Temporary", "Permanent":
-        for user in trip[driver][mode]:
+        for user in list(trip[driver].passengers(mode)):
             bot.send_message(chat_id=user,
                              text=f"Il viaggio di {get_name(driver)}"
                              f" per {day.lower()} {common.dir_name(direction)}"
@@ -185,7 +181,10 @@ def weekly_report():
     un messaggio con i crediti.
     """
 
-    for user in all_users():
+    for user in list(all_users()):
+        if not is_registered(user):
+            continue
+
         # Invio dei debiti per tutti gli utenti
         try:
             debits = get_debit_tuple(user)
@@ -3,7 +3,8 @@
 import datetime
 import logging as log
 
-from data.data_api import all_users, is_driver, all_directions, get_trip_group, get_name, get_bookings_day_nosusp
+from data.data_api import all_users, is_driver, all_directions, get_trip_group, get_name, get_mentions, \
+    get_bookings_day_nosusp
 from util import common
 
 
@@ -17,7 +18,7 @@ def remind():
             not in common.no_trip_days:
         # Il comando va eseguito solo nei giorni feriali e comunque non
         # nei giorni esplicitamente segnati in secrets.py
-        for chat_id in all_users():
+        for chat_id in list(all_users()):
             try:
                 remind_user(bot, chat_id)
             except Exception as ex:
@@ -38,7 +39,7 @@ def remind_driver(bot, chat_id):
 
     for direction in all_directions():
         trip = get_trip_group(direction, common.tomorrow())
-        if chat_id in trip and not trip[chat_id]["Suspended"]:
+        if chat_id in trip and not trip[chat_id].suspended:
             # Mando il messaggio iniziale una sola volta
             if not message:
                 message.append("⚠ Sommario dei tuoi viaggi di domani:")
@@ -46,19 +47,16 @@ def remind_driver(bot, chat_id):
             trip = trip[chat_id]
 
             if common.is_sessione():
-                people = ", ".join(f"[{get_name(user)}](tg://user?id={user})"
-                                   for user in trip["Temporary"])
+                people = ", ".join(get_mentions(trip.temporary))
 
-                message.append(f"\n\n🕓 {trip['Time']}"
+                message.append(f"\n\n🕓 {trip.time}"
                                f"\n{common.dir_name(direction)}"
                                f"\n👥: {people}")
             else:
-                permanent_people = ", ".join(f"[{get_name(user)}](tg://user?id={user})"
-                                             for user in trip["Permanent"])
-                temporary_people = ", ".join(f"[{get_name(user)}](tg://user?id={user})"
-                                             for user in trip["Temporary"])
+                permanent_people = ", ".join(get_mentions(trip.permanent))
+                temporary_people = ", ".join(get_mentions(trip.temporary))
 
-                message.append(f"\n\n🕓 {trip['Time']}"
+                message.append(f"\n\n🕓 {trip.time}"
                                f"\n{common.dir_name(direction)}"
                                f"\n👥 permanenti: {permanent_people}"
                                f"\n👥 temporanei: {temporary_people}")
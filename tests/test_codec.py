@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+import json
+import unittest
+
+from data import codec
+
+
+class CodecTest(unittest.TestCase):
+    """Compact format used to save users, drivers and trips"""
+
+    def test_round_trip(self):
+        values = [
+            None, True, False, 0, 1, -1, 2 ** 40, -2 ** 40, 1.5, "", "Lunedì", "🚗", [], {},
+            {"Name": "Alice", "Debit": {"123456789": -3, "-100200": 2}},
+            {"Time": "8:00", "Permanent": ["1", "2"], "Temporary": [], "SuspendedUsers": [], "Suspended": False,
+             "Location": None},
+            # Stringhe che sembrano numeri ma che non possono essere ricostruite dal loro valore
+            ["007", "-0", "+1", "1.0", "١٢"],
+        ]
+        for value in values:
+            with self.subTest(value=value):
+                data = codec.encode(value)
+                self.assertIsInstance(data, bytes)
+                self.assertFalse(codec.is_legacy(data))
+                self.assertEqual(codec.decode(data), value)
+
+    def test_types_are_preserved(self):
+        decoded = codec.decode(codec.encode({"1": 1, "True": True, "0": 0, "False": False}))
+        self.assertEqual([type(value) for value in decoded.values()], [int, bool, int, bool])
+
+    def test_repeated_strings_are_compressed(self):
+        value = {str(chat_id): {"Name": "Passeggero", "Debit": {"1": chat_id}} for chat_id in range(1000)}
+        data = codec.encode(value)
+        self.assertTrue(data[1] & codec.COMPRESSED)
+        self.assertLess(len(data), len(json.dumps(value)) // 2)
+        self.assertEqual(codec.decode(data), value)
+
+    def test_unknown_types_are_refused(self):
+        with self.assertRaises(TypeError):
+            codec.encode({"Time": object()})
+
+    def test_unknown_version_is_refused(self):
+        data = codec.encode({"Name": "Alice"})
+        with self.assertRaises(ValueError):
+            codec.decode(bytes((codec.VERSION + 1,)) + data[1:])
+
+    def test_legacy_json_is_decoded(self):
+        for value in ({"Name": "Alice", "Debit": {"2": 1}}, [{"Slots": 4}]):
+            for data in (json.dumps(value), json.dumps(value).encode("utf-8")):
+                with self.subTest(data=data):
+                    self.assertTrue(codec.is_legacy(data))
+                    self.assertEqual(codec.decode(data), value)
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+import math
+import sys
+import types
+import unittest
+
+# dataset.py contiene i dati dell'installazione e non fa parte del repository
+try:
+    import data.dataset
+except ImportError:
+    sys.modules["data.dataset"] = types.ModuleType("data.dataset")
+
+from data import data_api, dataset, dumpable
+from util import common
+
+
+class DataApiTest(unittest.TestCase):
+    """Queries of data_api answered through the lazy indexes, checked against a scan of the whole dataset"""
+
+    def setUp(self):
+        dumpable.Sync.generation += 1
+        dumpable.dirty.clear()
+        del dumpable.pending[:]
+
+        groups = {direction: {day: {} for day in common.work_days} for direction in ("Salita", "Discesa")}
+        # Nomi ripetuti e non in ordine, per verificare l'ordinamento per (nome, chat_id)
+        users = {str(chat_id): {"Name": name, "Debit": {}}
+                 for chat_id, name in enumerate(["Zoe", "Anna", "Marco", "Anna", "Luca", "Bea", "Marco", "Carla",
+                                                 "Dario", "Elena", "Franco", "Gina", "Anna"], start=1)}
+        dataset.groups, dataset.users, dataset.drivers = dumpable.from_dicts(groups, users, {})
+
+    def tearDown(self):
+        dumpable.dirty.clear()
+        del dumpable.pending[:]
+
+    def expected_page(self, page, excluded):
+        entries = sorted((user.name, chat_id) for chat_id, user in dataset.users.items() if chat_id not in excluded)
+        return (entries[page * common.PAGE_SIZE:(page + 1) * common.PAGE_SIZE],
+                int(math.ceil(len(entries) / common.PAGE_SIZE)))
+
+    def test_users_page_skips_the_excluded_users(self):
+        for excluded in ([], ["2"], ["2", "4", "13"], ["1", "8", "9", "10"], ["99", "3", "3"], list(dataset.users)):
+            for page in range(4):
+                with self.subTest(excluded=excluded, page=page):
+                    self.assertEqual(data_api.get_users_page(page, excluded), self.expected_page(page, excluded))
+
+    def test_users_page_follows_the_changes(self):
+        data_api.names_index()
+        data_api.add_user("14", "Aldo")
+        data_api.add_user("3", "Zeno")
+        data_api.delete_user("5")
+
+        self.assertEqual(data_api.get_new_passengers("1", 0), self.expected_page(0, ["1"]))
+        self.assertEqual(data_api.get_new_passengers("1", 2), self.expected_page(2, ["1"]))
+
+    def test_new_debitors_skip_the_current_debitors(self):
+        data_api.quick_debit_edit("2", "1", "+")
+        data_api.quick_debit_edit("4", "1", "-")
+
+        for page in range(3):
+            with self.subTest(page=page):
+                self.assertEqual(data_api.get_new_debitors("1", page), self.expected_page(page, ["1", "2", "4"]))
+
+    def test_departures_skip_malformed_times(self):
+        data_api.add_driver("1", 4)
+        data_api.add_driver("2", 4)
+        data_api.new_trip("Salita", "Lunedì", "1", "8:00")
+        data_api.new_trip("Salita", "Lunedì", "2", "8:3O")
+
+        with self.assertLogs(level="WARNING"):
+            dumpable.Sync.generation += 1
+            self.assertEqual(data_api.get_all_trips_fixed_direction("Salita", "Lunedì"), [("8:00", "1")])
+            self.assertEqual(data_api.get_all_trips_day("Lunedì"), [("8:00", "Zoe", "Salita", "1")])
+
+            data_api.remove_trip("Salita", "Lunedì", "2")
+
+    def expected_search(self, query):
+        prefixes = query.lower().split()
+        if not prefixes:
+            return []
+
+        trips = [(direction, day, driver) for direction in dataset.groups for day in common.work_days
+                 for driver in dataset.groups[direction][day]
+                 if all(any(word.startswith(prefix) for word in f"{day} {dataset.users[driver].name}".lower().split())
+                        for prefix in prefixes)]
+        return sorted(trips, key=lambda trip: (common.work_days.index(trip[1]), ("Salita", "Discesa").index(trip[0]),
+                                               common.time_to_minutes(dataset.groups[trip[0]][trip[1]][trip[2]].time)))
+
+    def test_search_matches_word_prefixes(self):
+        trips = [("1", "Salita", "Lunedì", "8:00"), ("2", "Salita", "Lunedì", "7:30"),
+                 ("3", "Discesa", "Lunedì", "17:00"), ("2", "Discesa", "Martedì", "18:00"),
+                 ("11", "Salita", "Venerdì", "10:00")]
+        for driver, direction, day, time in trips:
+            data_api.add_driver(driver, 3)
+            data_api.new_trip(direction, day, driver, time)
+
+        data_api.search_index()
+        data_api.add_user("2", "Anna Maria")
+        data_api.remove_trip("Salita", "Lunedì", "1")
+        data_api.new_trip("Salita", "Lunedì", "4", "9:00")
+
+        for query in ("lun", "LUN an", "mar", "anna ma", "maria", "fr ven", "lun zoe", "", "x"):
+            with self.subTest(query=query):
+                self.assertEqual(data_api.search_trips(query), self.expected_search(query))
+
+        self.assertEqual(data_api.search_trips("lunedì anna"),
+                         [("Salita", "Lunedì", "2"), ("Salita", "Lunedì", "4")])
+
+    def test_rolled_back_changes_are_not_saved(self):
+        data_api.add_driver("1", 4)
+        data_api.new_trip("Salita", "Lunedì", "1", "8:00")
+        dumpable.dirty.clear()
+        data_api.quick_debit_edit("2", "1", "+")
+        mutations = list(dumpable.pending)
+
+        # remove_passenger segna il viaggio come modificato prima di scoprire che il passeggero non c'è
+        with self.assertRaises(KeyError):
+            with data_api.transaction():
+                data_api.quick_debit_edit("3", "1", "+")
+                data_api.remove_passenger("Salita", "Lunedì", "1", "Permanent", "2")
+
+        self.assertEqual(dumpable.dirty, {("User", "2")})
+        self.assertEqual(dumpable.pending, mutations)
+        self.assertEqual(dataset.users["3"].debit, {})
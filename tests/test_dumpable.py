@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+import sys
+import threading
+import types
+import unittest
+
+# dataset.py contiene i dati dell'installazione e non fa parte del repository
+try:
+    import data.dataset
+except ImportError:
+    sys.modules["data.dataset"] = types.ModuleType("data.dataset")
+
+from data import data_api, dumpable
+from data.dumpable import RWLock
+
+
+class RWLockTest(unittest.TestCase):
+    """Reader/writer lock of the dataset, checked by trying to take it from another thread"""
+
+    def setUp(self):
+        self.lock = RWLock()
+
+    def try_from_other_thread(self, shared):
+        """
+        Checks whether another thread can take the lock right now, in shared or exclusive mode. If it cannot,
+        the thread keeps waiting and takes the lock as soon as it is released.
+        """
+        taken = threading.Event()
+
+        def take():
+            with self.lock.reading() if shared else self.lock:
+                taken.set()
+
+        threading.Thread(target=take, daemon=True).start()
+        return taken.wait(0.2)
+
+    def test_exclusive_is_reentrant(self):
+        with self.lock:
+            with self.lock:
+                with self.lock.reading():
+                    self.assertFalse(self.try_from_other_thread(shared=True))
+            self.assertFalse(self.try_from_other_thread(shared=False))
+
+        self.assertTrue(self.try_from_other_thread(shared=False))
+
+    def test_readers_share_the_lock(self):
+        with self.lock.reading():
+            with self.lock.reading():
+                self.assertTrue(self.try_from_other_thread(shared=True))
+                self.assertFalse(self.try_from_other_thread(shared=False))
+
+        self.assertTrue(self.try_from_other_thread(shared=False))
+
+    def test_reader_cannot_upgrade(self):
+        with self.lock.reading():
+            with self.assertRaises(RuntimeError):
+                with self.lock:
+                    pass
+
+    def test_released_gives_back_the_whole_depth(self):
+        with self.lock:
+            with self.lock:
+                with self.lock.released():
+                    self.assertTrue(self.try_from_other_thread(shared=False))
+                self.assertFalse(self.try_from_other_thread(shared=True))
+                self.assertEqual(self.lock.depth, 2)
+            self.assertFalse(self.try_from_other_thread(shared=True))
+
+        self.assertTrue(self.try_from_other_thread(shared=False))
+
+    def test_released_reader(self):
+        with self.lock.reading():
+            with self.lock.released():
+                self.assertTrue(self.try_from_other_thread(shared=False))
+            self.assertFalse(self.try_from_other_thread(shared=False))
+
+        self.assertTrue(self.try_from_other_thread(shared=False))
+
+    def test_released_without_lock(self):
+        with self.lock.released():
+            self.assertTrue(self.try_from_other_thread(shared=False))
+
+
+class UnlockedTest(unittest.TestCase):
+    """unlocked releases the dataset lock, except inside a transaction"""
+
+    def test_releases_the_lock(self):
+        with dumpable.lock:
+            with dumpable.unlocked():
+                self.assertIsNone(dumpable.lock.writer)
+            self.assertEqual(dumpable.lock.writer, threading.get_ident())
+
+    def test_keeps_the_lock_inside_a_transaction(self):
+        with data_api.transaction():
+            with dumpable.unlocked():
+                self.assertEqual(dumpable.lock.writer, threading.get_ident())
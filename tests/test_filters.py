@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+import sys
+import types
+import unittest
+
+# dataset.py e secrets.py contengono i dati dell'installazione e non fanno parte del repository
+for module in ("data.dataset", "data.secrets"):
+    try:
+        __import__(module)
+    except ImportError:
+        sys.modules[module] = types.ModuleType(module)
+
+try:
+    import telegram
+except ImportError:
+    raise unittest.SkipTest("python-telegram-bot is not installed")
+
+from routing.filters import CALLBACK_TOKENS, CALLBACK_VERSION, create_callback_data, separate_callback_data
+
+
+class CallbackDataTest(unittest.TestCase):
+    """Compact format of the callback data of the inline buttons"""
+
+    def test_round_trip(self):
+        values = [
+            ("EXIT",),
+            ("BOOKING", "CONFIRM", "Salita", "Mercoledì", "123456789", "Temporary"),
+            ("EDIT_MONEY", "-1001234567890", "0", "-5", "61", "62"),
+            # Stringhe che sembrano numeri ma che non possono essere ricostruite dal loro valore
+            ("LIST", "007", "-0", "+1", "1.5", "١٢"),
+            # Valori che iniziano con i caratteri usati dalla codifica, e valori vuoti
+            ("ME", "#1", "'", "~1", "", "Povo 1 (parcheggio VIP)", "exit"),
+        ]
+        for args in values:
+            with self.subTest(args=args):
+                data = create_callback_data(*args)
+                self.assertTrue(data.startswith(CALLBACK_VERSION))
+                self.assertEqual(separate_callback_data(data), list(args))
+
+    def test_values_are_converted_to_strings(self):
+        self.assertEqual(separate_callback_data(create_callback_data("MINUTE", 5, -10, 2 ** 40)),
+                         ["MINUTE", "5", "-10", str(2 ** 40)])
+
+    def test_every_token_is_a_single_code(self):
+        for token in CALLBACK_TOKENS:
+            with self.subTest(token=token):
+                data = create_callback_data(token)
+                self.assertLessEqual(len(data), len(CALLBACK_VERSION) + 2)
+                self.assertEqual(separate_callback_data(data), [token])
+
+    def test_longest_buttons_fit_in_telegram_limit(self):
+        data = create_callback_data("BOOKING", "CONFIRM", "Discesa", "Mercoledì", "-1001234567890", "SuspendedUsers")
+        self.assertLessEqual(len(data.encode("utf-8")), 64)
+
+    def test_previous_format_is_still_accepted(self):
+        self.assertEqual(separate_callback_data("BOOKING;CONFIRM;Salita;Lunedì;123456789;Permanent"),
+                         ["BOOKING", "CONFIRM", "Salita", "Lunedì", "123456789", "Permanent"])
+        self.assertEqual(separate_callback_data("EXIT"), ["EXIT"])
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+import sys
+import types
+import unittest
+
+# dataset.py e secrets.py contengono i dati dell'installazione e non fanno parte del repository
+for module in ("data.dataset", "data.secrets"):
+    try:
+        __import__(module)
+    except ImportError:
+        sys.modules[module] = types.ModuleType(module)
+
+try:
+    import telegram
+except ImportError:
+    raise unittest.SkipTest("python-telegram-bot is not installed")
+
+from data import dataset, dumpable
+from util import common
+from util.keyboards import trips_keyboard
+
+
+class TripsKeyboardTest(unittest.TestCase):
+    """Keyboard of the trips of a driver, rendered from the Trip objects of the dataset"""
+
+    def setUp(self):
+        dumpable.Sync.generation += 1
+
+        groups = {direction: {day: {} for day in common.work_days} for direction in ("Salita", "Discesa")}
+        groups["Salita"]["Lunedì"] = {
+            "1": {"Time": "8:00", "Permanent": ["2"], "Temporary": ["3"], "SuspendedUsers": ["4"], "Suspended": False},
+            "2": {"Time": "9:00", "Permanent": [], "Temporary": [], "SuspendedUsers": [], "Suspended": False}
+        }
+        groups["Discesa"]["Mercoledì"] = {
+            "1": {"Time": "17:30", "Permanent": ["2"], "Temporary": [], "SuspendedUsers": [], "Suspended": True}
+        }
+        users = {chat_id: {"Name": name, "Debit": {}} for chat_id, name in (("1", "Alice"), ("2", "Bob"),
+                                                                           ("3", "Carol"), ("4", "Dave"))}
+        dataset.groups, dataset.users, dataset.drivers = dumpable.from_dicts(groups, users,
+                                                                            {"1": {"Slots": 4}, "2": {"Slots": 2}})
+
+    def trip_buttons(self, chat_id):
+        rows = trips_keyboard(chat_id).inline_keyboard
+        # Il primo bottone aggiunge un viaggio, gli ultimi due tornano indietro ed escono
+        return {button.text: button.callback_data for row in rows[1:-2] for button in row}
+
+    def test_trips_show_time_and_occupied_seats(self):
+        buttons = self.trip_buttons("1")
+
+        self.assertEqual(len(buttons), 2)
+        self.assertIn(f"Lunedì: 8:00 {common.dir_name('Salita')} (2)", buttons)
+        self.assertIn(f"Mercoledì: 17:30 {common.dir_name('Discesa')} (SOSP.)", buttons)
+
+    def test_driver_without_trips(self):
+        self.assertEqual(self.trip_buttons("3"), {})
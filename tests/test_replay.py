@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import tempfile
+import time
+import types
+import unittest
+
+# dataset.py contiene i dati dell'installazione e non fa parte del repository
+try:
+    import data.dataset
+except ImportError:
+    sys.modules["data.dataset"] = types.ModuleType("data.dataset")
+
+from data import codec, data_api, dataset, dumpable, storage
+from util import common
+
+
+class ReplayTest(unittest.TestCase):
+    """Saves that conflict with another instance, on the SQLite backend"""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.settings = common.STORAGE, common.SQLITE_PATH, common.LOCAL_SNAPSHOT_PATH
+        common.STORAGE = "sqlite"
+        common.SQLITE_PATH = os.path.join(self.directory.name, "test.db")
+        common.LOCAL_SNAPSHOT_PATH = None
+        storage.Backend.instance = None
+
+        # Ogni test parte da un database vuoto, senza modifiche in sospeso
+        dumpable.Sync.version = dumpable.Sync.snapshot = 0
+        dumpable.Sync.unsnapshotted.clear()
+        dumpable.Sync.generation += 1
+        dumpable.dirty.clear()
+        del dumpable.pending[:]
+
+        dataset.groups = {direction: {day: {} for day in common.work_days} for direction in ("Salita", "Discesa")}
+        dataset.users = {"1": {"Name": "Alice", "Debit": {}}, "2": {"Name": "Bob", "Debit": {"1": -1}},
+                         "3": {"Name": "Carol", "Debit": {}}}
+        dataset.drivers = {"1": {"Slots": 1}}
+        dataset.groups["Salita"]["Lunedì"] = {
+            "1": {"Time": "8:00", "Permanent": [], "Temporary": [], "SuspendedUsers": ["2"], "Suspended": False}
+        }
+        self.assertTrue(dumpable.dump_data(full=True))
+
+    def tearDown(self):
+        common.STORAGE, common.SQLITE_PATH, common.LOCAL_SNAPSHOT_PATH = self.settings
+        storage.Backend.instance = None
+        self.directory.cleanup()
+
+    def save_from_other_instance(self, kind, name, value):
+        """Appends a record to the log as another instance would, so that the next local save conflicts"""
+        other = storage.SqliteStorage(common.SQLITE_PATH)
+        record = codec.encode({"Time": int(time.time()), "Ops": [], "Changes": [[kind, name, value]]})
+        other.append(record, other.get_version())
+
+    def test_conditional_debit_is_replayed_as_a_unit(self):
+        self.save_from_other_instance("User", "2", {"Name": "Bob", "Debit": {"1": 3}})
+
+        # In locale il debito torna a zero e viene rimosso, ma sui dati salvati diventa 4
+        self.assertEqual(data_api.charge_trip("2", "1"), 0)
+        self.assertTrue(dumpable.dump_data())
+
+        self.assertEqual(dataset.users["2"].debit, {"1": 4})
+        self.assertEqual(data_api.get_credits("1"), [("2", 4)])
+
+    def test_restore_refused_on_full_trip_keeps_the_booking(self):
+        self.save_from_other_instance("Trip", "Salita/Lunedì/1", {
+            "Time": "8:00", "Permanent": ["3"], "Temporary": [], "SuspendedUsers": ["2"], "Suspended": False
+        })
+
+        # In locale il posto è libero, ma un'altra istanza l'ha già dato a Carol
+        self.assertEqual(data_api.restore_suspended_booking("Salita", "Lunedì", "1", "2"), 0)
+        with self.assertLogs(level="ERROR"):
+            self.assertTrue(dumpable.dump_data())
+
+        trip = dataset.groups["Salita"]["Lunedì"]["1"]
+        self.assertEqual(list(trip.permanent), ["3"])
+        self.assertEqual(list(trip.suspended_users), ["2"])
@@ -6,6 +6,49 @@ import pytz
 
 PAGE_SIZE = 5  # Numero di bottoni per pagina (in caso di visualizzazione di utenti multipli)
 MAX_ATTEMPTS = 5  # Tentativi massimi di processo del webhook
+SHARDS = 4  # Thread che elaborano gli update, ciascuno quelli di un sottoinsieme degli utenti (vedi routing.webhook)
+WORKERS = 4  # Thread che eseguono in parallelo gli handler in sola lettura (vedi routing.filters.read_only)
+SENDERS = 2  # Thread che inviano in background le chiamate di cui non serve il risultato (vedi routing.sender)
+
+# Salvataggio dei dati: di default vengono salvati a ogni update, prima di confermare l'operazione all'utente.
+# Con WRITE_BEHIND attivo vengono invece salvati da un thread separato ogni FLUSH_INTERVAL secondi oppure dopo
+# FLUSH_THRESHOLD modifiche: le modifiche già confermate ma non ancora salvate vanno perse se l'istanza termina
+# o va in crash. Su App Engine i thread in background vengono rallentati tra una richiesta e l'altra, quindi
+# questo intervallo può essere anche molto più lungo di FLUSH_INTERVAL
+WRITE_BEHIND = False
+FLUSH_INTERVAL = 2
+FLUSH_THRESHOLD = 20
+
+# Backend di salvataggio dei dati: "datastore" (Google Cloud Datastore) oppure "sqlite" (file locale
+# in SQLITE_PATH, per l'esecuzione su una singola macchina e per le misurazioni)
+STORAGE = "datastore"
+SQLITE_PATH = "ubernest.db"
+
+# Ogni salvataggio aggiunge un record al log; dopo COMPACT_THRESHOLD record le entità modificate vengono
+# riscritte nello snapshot, così che al caricamento vada riletta solo la coda del log
+COMPACT_THRESHOLD = 100
+
+# Copia locale dei dati, aggiornata dopo ogni salvataggio e usata all'avvio al posto del backend se ancora
+# valida (None per disattivarla). Su App Engine l'unica cartella scrivibile è /tmp
+LOCAL_SNAPSHOT_PATH = "/tmp/ubernest.snapshot"
+
+# Risposte alle query inline: al massimo INLINE_PAGE_SIZE risultati per pagina (il limite di Telegram), tenuti
+# in cache da Telegram per INLINE_CACHE_TIME secondi e dal bot finché i dati non cambiano, per al massimo
+# INLINE_CACHE_SIZE query diverse
+INLINE_PAGE_SIZE = 50
+INLINE_CACHE_TIME = 30
+INLINE_CACHE_SIZE = 256
+
+# Con WEBHOOK_REPLY attivo la prima chiamata alla Bot API di ogni update viene restituita come risposta al
+# webhook invece di essere inviata (vedi routing.webhook_reply), attendendo al massimo WEBHOOK_REPLY_TIMEOUT
+# secondi che l'update venga elaborato. Telegram non segnala gli errori di queste chiamate, che vanno quindi
+# perse senza avviso: va attivato solo dopo aver verificato che i messaggi del bot vengano sempre accettati
+WEBHOOK_REPLY = False
+WEBHOOK_REPLY_TIMEOUT = 2
+
+# Secondi dopo i quali viene mostrato "Sto scrivendo..." mentre si elabora una callback query: gli handler più
+# veloci non lo inviano affatto
+CHAT_ACTION_DELAY = 0.5
 
 # Localizzazione italiana dei nomi dei giorni della settimana
 days = ["Lunedì", "Martedì", "Mercoledì", "Giovedì", "Venerdì", "Sabato", "Domenica"]
@@ -94,6 +137,12 @@ def is_dst():
     return pytz.timezone("Europe/Rome").localize(datetime.datetime.now()).dst() == datetime.timedelta(0, 3600)
 
 
+def time_to_minutes(time):
+    """Converte un orario nel formato %H:%M nei minuti trascorsi dalla mezzanotte"""
+    hour, minute = time.split(":")
+    return int(hour) * 60 + int(minute)
+
+
 def is_booking_time():
     """Controlla che l'orario attuale sia compreso all'interno degli orari di prenotazioni definiti sopra"""
     return datetime.time(2, 16) <= now_time() <= datetime.time(23, 59) or \
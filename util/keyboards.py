@@ -46,26 +46,26 @@ def trips_keyboard(chat_id):
             continue
 
         for direction in "Salita", "Discesa":
-            try:
-                group = get_trip(direction, day, chat_id)
-
-                if group["Suspended"]:
-                    counter = "SOSP."
-                else:
-                    counter = f"{len(group['Permanent']) + len(group['Temporary'])}"
-
-                if common.is_sessione():
-                    shown_day = f"{day} {datetime.datetime.today().day + item}"
-                else:
-                    shown_day = day
-
-                keyboard.append(
-                    [InlineKeyboardButton(f"{shown_day}: {group['Time']}"
-                                          f" {common.dir_name(direction)} ({counter})",
-                                          callback_data=ccd("TRIPS", "EDIT_TRIP", direction, day))])
-            except Exception:  # Viaggio non segnato...
+            group = get_trip(direction, day, chat_id)
+
+            if group is None:  # Viaggio non segnato...
                 continue
 
+            if group.suspended:
+                counter = "SOSP."
+            else:
+                counter = f"{group.occupied_slots()}"
+
+            if common.is_sessione():
+                shown_day = f"{day} {datetime.datetime.today().day + item}"
+            else:
+                shown_day = day
+
+            keyboard.append(
+                [InlineKeyboardButton(f"{shown_day}: {group.time}"
+                                      f" {common.dir_name(direction)} ({counter})",
+                                      callback_data=ccd("TRIPS", "EDIT_TRIP", direction, day))])
+
     keyboard.append([InlineKeyboardButton("↩ Indietro", callback_data=ccd("ME_MENU"))])
     keyboard.append([InlineKeyboardButton("🔚 Esci", callback_data=ccd("EXIT"))])
 